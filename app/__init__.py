@@ -30,6 +30,14 @@ def create_app(config_name):
     login_manager.init_app(app)
     csrf.init_app(app)
 
+    if app.config['MINIFY_TEMPLATES']:
+        from app.utils import MinifyExtension
+        app.jinja_env.add_extension(MinifyExtension)
+
+    # registered first so that its hooks wrap those of the blueprints
+    from app import profiling
+    profiling.init_app(app)
+
     from app.views.main import main as main_blueprint
     app.register_blueprint(main_blueprint)
 
@@ -60,4 +68,16 @@ def create_app(config_name):
     from app.views.search import search as search_blueprint
     app.register_blueprint(search_blueprint, url_prefix='/search')
 
+    from app import punches
+    punches.init_app(app)
+
+    from app import presence
+    presence.init_app(app)
+
+    from app import metrics
+    metrics.init_app(app)
+
+    from app import tasks
+    tasks.init_app(app)
+
     return app
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+'''app/catalog.py'''
+
+import os
+import re
+from collections import namedtuple
+from threading import RLock
+from flask import current_app, render_template, g, has_request_context
+from app import db
+from app.models import LessonType, Lesson, Video
+from app.utils import read_version, bump_version
+from app.utils import minify
+
+
+SLOT_PATTERN = re.compile(r'\[\[(progress|study):(\d+)\]\]')
+
+LessonSlot = namedtuple('LessonSlot', ['id', 'type_id'])
+
+CatalogFragment = namedtuple('CatalogFragment', ['markup', 'lessons', 'buttons'])
+
+
+class CatalogCache:
+    '''catalog.CatalogCache'''
+
+    def __init__(self):
+        self.lock = RLock()
+        self.version = None
+        self.fragments = {}
+
+    @property
+    def version_file(self):
+        '''CatalogCache.version_file(self)'''
+        return os.path.join(current_app.config['CACHE_DIR'], 'catalog.version')
+
+    def invalidate(self):
+        '''CatalogCache.invalidate(self)'''
+        with self.lock:
+            self.fragments = {}
+
+    def validate(self):
+        '''CatalogCache.validate(self)'''
+        # lessons are changed by another process (manage.py deploy): check once per request
+        if has_request_context():
+            if g.get('catalog_cache_validated', False):
+                return
+            g.catalog_cache_validated = True
+        version = read_version(version_file=self.version_file)
+        if version != self.version:
+            self.invalidate()
+            self.version = version
+
+    def fragment(self, template, lesson_type):
+        '''CatalogCache.fragment(self, template, lesson_type)'''
+        self.validate()
+        key = (template, lesson_type)
+        with self.lock:
+            fragment = self.fragments.get(key)
+            if fragment is None:
+                fragment = render_fragment(template=template, lesson_type=lesson_type)
+                self.fragments[key] = fragment
+            return fragment
+
+    @staticmethod
+    def on_changed_entry(mapper, connection, target):
+        '''CatalogCache.on_changed_entry(mapper, connection, target)'''
+        catalog_cache.invalidate()
+        session = db.object_session(target)
+        if session is not None:
+            session.info['catalog_cache_changed'] = True
+
+    @staticmethod
+    def on_session_commit(session):
+        '''CatalogCache.on_session_commit(session)'''
+        if session.info.pop('catalog_cache_changed', False):
+            catalog_cache.invalidate()
+            catalog_cache.version = bump_version(version_file=catalog_cache.version_file)
+
+    @staticmethod
+    def on_session_rollback(session, previous_transaction):
+        '''CatalogCache.on_session_rollback(session, previous_transaction)'''
+        if session.info.pop('catalog_cache_changed', False):
+            catalog_cache.invalidate()
+
+
+catalog_cache = CatalogCache()
+
+for model in (LessonType, Lesson, Video):
+    for event_name in ('after_insert', 'after_update', 'after_delete'):
+        db.event.listen(model, event_name, CatalogCache.on_changed_entry)
+db.event.listen(db.session, 'after_commit', CatalogCache.on_session_commit)
+db.event.listen(db.session, 'after_soft_rollback', CatalogCache.on_session_rollback)
+
+
+def render_fragment(template, lesson_type):
+    '''catalog.render_fragment(template, lesson_type)'''
+    lessons = Lesson.query\
+        .join(LessonType, LessonType.id == Lesson.type_id)\
+        .filter(LessonType.name == lesson_type)\
+        .options(db.contains_eager(Lesson.type))\
+        .order_by(Lesson.id.asc())\
+        .all()
+    markup = minify(render_template(template, header=lesson_type, lessons=lessons))
+    # per-user buttons are rendered once for both states and picked when the page is served
+    buttons = {}
+    macros = current_app.jinja_env.get_template(template).module
+    if hasattr(macros, 'study_button') and hasattr(macros, 'locked_button'):
+        buttons = {lesson.id: (
+            minify(str(macros.study_button(lesson=lesson))),
+            minify(str(macros.locked_button(lesson=lesson))),
+        ) for lesson in lessons}
+    return CatalogFragment(
+        markup=markup,
+        lessons={lesson.id: LessonSlot(id=lesson.id, type_id=lesson.type_id) for lesson in lessons},
+        buttons=buttons
+    )
+
+
+def fill_slots(fragment, user):
+    '''catalog.fill_slots(fragment, user)'''
+    def fill(match):
+        lesson = fragment.lessons[int(match.group(2))]
+        if match.group(1) == 'progress':
+            return user.lesson_progress_percentage(lesson=lesson)
+        if user.can_study(lesson=lesson):
+            return fragment.buttons[lesson.id][0]
+        return fragment.buttons[lesson.id][1]
+    return SLOT_PATTERN.sub(fill, fragment.markup)
+
+
+def render_catalog(template, fragment_template, lesson_type, user=None):
+    '''catalog.render_catalog(template, fragment_template, lesson_type, user=None)'''
+    fragment = catalog_cache.fragment(template=fragment_template, lesson_type=lesson_type)
+    catalog = fragment.markup
+    if user is not None:
+        catalog = fill_slots(fragment=fragment, user=user)
+    # only the page shell (messages, navigation) is rendered and minified per request
+    page = minify(render_template(template, header=lesson_type, catalog='[[catalog]]'))
+    return page.replace('[[catalog]]', catalog, 1)
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+'''app/hls.py'''
+
+import os
+import io
+import json
+import fcntl
+import hashlib
+import subprocess
+from shutil import rmtree
+from contextlib import contextmanager
+from pymediainfo import MediaInfo
+
+
+def file_stamp(source):
+    '''hls.file_stamp(source)'''
+    file_stat = os.stat(source)
+    return '{:x}-{:x}'.format(file_stat.st_size, file_stat.st_mtime_ns)
+
+
+def file_content_hash(source, chunk_size=1024 * 1024):
+    '''hls.file_content_hash(source, chunk_size=1024 * 1024)'''
+    content_hash = hashlib.sha256()
+    with open(source, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+
+def ladder_signature(renditions, segment_duration):
+    '''hls.ladder_signature(renditions, segment_duration)'''
+    if not renditions:
+        return 'source-{}'.format(segment_duration)
+    return hashlib.sha1(json.dumps(
+        [renditions, segment_duration],
+        sort_keys=True
+    ).encode('utf-8')).hexdigest()[:12]
+
+
+def parse_bitrate(bitrate):
+    '''hls.parse_bitrate(bitrate)'''
+    bitrate = str(bitrate).strip().lower()
+    if bitrate.endswith('k'):
+        return int(float(bitrate[:-1]) * 1000)
+    if bitrate.endswith('m'):
+        return int(float(bitrate[:-1]) * 1000 * 1000)
+    return int(bitrate)
+
+
+def get_video_size(source):
+    '''hls.get_video_size(source)'''
+    for track in MediaInfo.parse(source).tracks:
+        if track.track_type == 'Video' and track.width and track.height:
+            return int(track.width), int(track.height)
+    return None
+
+
+def lower_priority(niceness):
+    '''hls.lower_priority(niceness)'''
+    os.nice(niceness)
+
+
+@contextmanager
+def package_lock(package_dir):
+    '''hls.package_lock(package_dir)'''
+    with open('{}.lock'.format(package_dir), 'a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def segment_video(source, rendition_dir, segment_duration, ffmpeg, rendition=None, threads=0):
+    '''hls.segment_video(source, rendition_dir, segment_duration, ffmpeg, rendition=None, threads=0)'''
+    if rendition is None:
+        codec_args = ['-map', '0', '-c', 'copy']
+    else:
+        video_bitrate = parse_bitrate(rendition['video_bitrate'])
+        codec_args = [
+            '-map', '0:v:0',
+            '-map', '0:a:0?',
+            '-vf', 'scale=-2:{}'.format(rendition['height']),
+            '-c:v', 'libx264',
+            '-preset', 'veryfast',
+            '-b:v', str(video_bitrate),
+            '-maxrate', str(int(video_bitrate * 1.1)),
+            '-bufsize', str(video_bitrate * 2),
+            '-force_key_frames', 'expr:gte(t,n_forced*{})'.format(segment_duration),
+            '-sc_threshold', '0',
+            '-c:a', 'aac',
+            '-b:a', str(parse_bitrate(rendition['audio_bitrate'])),
+            '-threads', str(threads),
+        ]
+    subprocess.run([ffmpeg, '-y', '-v', 'error', '-i', source] + codec_args + [
+        '-f', 'hls',
+        '-hls_time', str(segment_duration),
+        '-hls_playlist_type', 'vod',
+        '-hls_segment_filename', os.path.join(rendition_dir, 'segment%05d.ts'),
+        os.path.join(rendition_dir, 'index.m3u8'),
+    ], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+
+def select_renditions(source, renditions):
+    '''hls.select_renditions(source, renditions)'''
+    video_size = get_video_size(source)
+    if video_size is None:
+        return list(renditions), None
+    # never upscale, but always keep the lowest rendition
+    selected = [rendition for rendition in renditions if rendition['height'] <= video_size[1]]
+    if not selected:
+        selected = [min(renditions, key=lambda rendition: rendition['height'])]
+    return selected, video_size
+
+
+def write_master_playlist(package_dir, renditions, video_size=None):
+    '''hls.write_master_playlist(package_dir, renditions, video_size=None)'''
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3']
+    for rendition in sorted(renditions, key=lambda rendition: rendition['height']):
+        attributes = ['BANDWIDTH={}'.format(int((
+            parse_bitrate(rendition['video_bitrate']) + parse_bitrate(rendition['audio_bitrate'])
+        ) * 1.1))]
+        if video_size is not None:
+            width = int(round(video_size[0] * rendition['height'] / video_size[1] / 2)) * 2
+            attributes.append('RESOLUTION={}x{}'.format(width, rendition['height']))
+        attributes.append('NAME="{}"'.format(rendition['name']))
+        lines.append('#EXT-X-STREAM-INF:{}'.format(','.join(attributes)))
+        lines.append('{}/index.m3u8'.format(rendition['name']))
+    with io.open(os.path.join(package_dir, 'index.m3u8'), 'wt', newline='\n') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def package_video(source, segment_dir, segment_duration, ffmpeg, renditions=None, threads=0, content_hash=None,
+    force=False):
+    '''hls.package_video(source, segment_dir, segment_duration, ffmpeg, renditions=None, threads=0, content_hash=None,
+    force=False)'''
+    if content_hash is None:
+        content_hash = file_content_hash(source)
+    package_dir = os.path.join(segment_dir, content_hash, ladder_signature(renditions, segment_duration))
+    os.makedirs(os.path.dirname(package_dir), exist_ok=True)
+    with package_lock(package_dir):
+        if not force and os.path.exists(os.path.join(package_dir, 'index.m3u8')):
+            # identical content has been packaged already
+            return content_hash
+        # finished renditions survive in the partial directory, so an interrupted run resumes
+        partial_package_dir = '{}.partial'.format(package_dir)
+        if force:
+            rmtree(partial_package_dir, ignore_errors=True)
+        os.makedirs(partial_package_dir, exist_ok=True)
+        if renditions:
+            selected_renditions, video_size = select_renditions(source, renditions)
+        else:
+            selected_renditions, video_size = [None], None
+        for rendition in selected_renditions:
+            if rendition is None:
+                segment_video(
+                    source=source,
+                    rendition_dir=partial_package_dir,
+                    segment_duration=segment_duration,
+                    ffmpeg=ffmpeg
+                )
+                continue
+            rendition_dir = os.path.join(partial_package_dir, rendition['name'])
+            if os.path.exists(rendition_dir):
+                continue
+            temporary_rendition_dir = '{}.tmp'.format(rendition_dir)
+            rmtree(temporary_rendition_dir, ignore_errors=True)
+            os.makedirs(temporary_rendition_dir)
+            segment_video(
+                source=source,
+                rendition_dir=temporary_rendition_dir,
+                segment_duration=segment_duration,
+                ffmpeg=ffmpeg,
+                rendition=rendition,
+                threads=threads
+            )
+            os.rename(temporary_rendition_dir, rendition_dir)
+        if renditions:
+            write_master_playlist(
+                package_dir=partial_package_dir,
+                renditions=selected_renditions,
+                video_size=video_size
+            )
+        if os.path.exists(package_dir):
+            # a forced run replaces the package: symlinked HLS caches follow the path
+            previous_package_dir = '{}.previous'.format(package_dir)
+            rmtree(previous_package_dir, ignore_errors=True)
+            os.rename(package_dir, previous_package_dir)
+            os.rename(partial_package_dir, package_dir)
+            rmtree(previous_package_dir, ignore_errors=True)
+        else:
+            os.rename(partial_package_dir, package_dir)
+    return content_hash
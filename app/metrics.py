@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+
+'''app/metrics.py'''
+
+import os
+import io
+import json
+import atexit
+from glob import glob
+from bisect import bisect_left
+from threading import Lock
+from contextlib import contextmanager
+from time import perf_counter
+from secrets import token_hex
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class MetricsRegistry:
+    '''metrics.MetricsRegistry'''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.pid = os.getpid()
+        self.metrics = []
+
+    def register(self, metric):
+        '''MetricsRegistry.register(self, metric)'''
+        self.metrics.append(metric)
+
+    def check_fork(self):
+        '''MetricsRegistry.check_fork(self)'''
+        # a forked worker starts from zero instead of counting its parent's values again
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            for metric in self.metrics:
+                metric.values = {}
+
+    def snapshot(self):
+        '''MetricsRegistry.snapshot(self)'''
+        with self.lock:
+            self.check_fork()
+            return {metric.name: {
+                json.dumps(list(key)): value for key, value in metric.values.items()
+            } for metric in self.metrics}
+
+    def export(self, metrics_dir):
+        '''MetricsRegistry.export(self, metrics_dir)'''
+        snapshot = self.snapshot()
+        os.makedirs(metrics_dir, exist_ok=True)
+        metrics_file = os.path.join(metrics_dir, '{}.json'.format(os.getpid()))
+        write_snapshot(metrics_file=metrics_file, snapshot=snapshot)
+
+
+class Metric:
+    '''metrics.Metric'''
+
+    type_name = None
+
+    def __init__(self, registry, name, documentation, label_names=()):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.values = {}
+        registry.register(self)
+
+    def key(self, labels):
+        '''Metric.key(self, labels)'''
+        return tuple(str(labels.get(label_name, '')) for label_name in self.label_names)
+
+    def merge(self, total, value):
+        '''Metric.merge(self, total, value)'''
+        return value if total is None else total + value
+
+
+class Counter(Metric):
+    '''metrics.Counter(Metric)'''
+
+    type_name = 'counter'
+
+    def inc(self, amount=1, **labels):
+        '''Counter.inc(self, amount=1, **labels)'''
+        key = self.key(labels)
+        with self.registry.lock:
+            self.registry.check_fork()
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Counter):
+    '''metrics.Gauge(Counter)'''
+
+    type_name = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        '''Gauge.dec(self, amount=1, **labels)'''
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    '''metrics.Histogram(Metric)'''
+
+    type_name = 'histogram'
+
+    def __init__(self, registry, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(registry=registry, name=name, documentation=documentation, label_names=label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        '''Histogram.observe(self, value, **labels)'''
+        key = self.key(labels)
+        with self.registry.lock:
+            self.registry.check_fork()
+            entry = self.values.get(key)
+            if entry is None:
+                entry = {'buckets': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0}
+                self.values[key] = entry
+            # per-bucket counts: they are accumulated when rendered
+            entry['buckets'][bisect_left(self.buckets, value)] += 1
+            entry['sum'] += value
+            entry['count'] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        '''Histogram.time(self, **labels)'''
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def merge(self, total, value):
+        '''Histogram.merge(self, total, value)'''
+        if total is None:
+            return {'buckets': list(value['buckets']), 'sum': value['sum'], 'count': value['count']}
+        if len(total['buckets']) == len(value['buckets']):
+            total['buckets'] = [a + b for a, b in zip(total['buckets'], value['buckets'])]
+            total['sum'] += value['sum']
+            total['count'] += value['count']
+        return total
+
+
+registry = MetricsRegistry()
+
+video_requests = Counter(registry, 'yvod_video_requests_total',
+    'Video file requests by response status.', ['status'])
+video_bytes = Counter(registry, 'yvod_video_bytes_total',
+    'Bytes announced in the Content-Length of video file responses (HEAD excluded, aborted streams included).')
+video_streams = Gauge(registry, 'yvod_video_active_streams',
+    'Video file responses currently being streamed.')
+hls_urls = Counter(registry, 'yvod_hls_urls_issued_total',
+    'HLS playlist URLs issued to video pages.', ['lesson_type'])
+punches = Counter(registry, 'yvod_punches_total',
+    'Study punches by write mode.', ['mode'])
+punch_duration = Histogram(registry, 'yvod_punch_duration_seconds',
+    'Time spent handling a study punch.')
+ysys_requests = Counter(registry, 'yvod_ysys_requests_total',
+    'Y-System API requests by outcome.', ['api', 'outcome'])
+ysys_duration = Histogram(registry, 'yvod_ysys_request_duration_seconds',
+    'Y-System API request latency.', ['api'])
+auth_duration = Histogram(registry, 'yvod_auth_before_request_duration_seconds',
+    'Time spent in auth.before_request.')
+
+
+def write_snapshot(metrics_file, snapshot):
+    '''metrics.write_snapshot(metrics_file, snapshot)'''
+    temporary_metrics_file = '{}.{}.tmp'.format(metrics_file, token_hex(4))
+    with io.open(temporary_metrics_file, 'wt', encoding='utf-8') as f:
+        json.dump(snapshot, f)
+    os.replace(temporary_metrics_file, metrics_file)
+
+
+def read_snapshot(metrics_file):
+    '''metrics.read_snapshot(metrics_file)'''
+    try:
+        with io.open(metrics_file, 'rt', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def merge_snapshot(totals, snapshot, include_gauges=True):
+    '''metrics.merge_snapshot(totals, snapshot, include_gauges=True)'''
+    for metric in registry.metrics:
+        if metric.type_name == 'gauge' and not include_gauges:
+            continue
+        metric_totals = totals.setdefault(metric.name, {})
+        for key, value in snapshot.get(metric.name, {}).items():
+            metric_totals[key] = metric.merge(metric_totals.get(key), value)
+    return totals
+
+
+def collect(metrics_dir):
+    '''metrics.collect(metrics_dir)'''
+    from app.punches import process_alive
+    from app.tasks import file_lock
+    registry.export(metrics_dir=metrics_dir)
+    archive_file = os.path.join(metrics_dir, 'archive.json')
+    with file_lock(os.path.join(metrics_dir, 'archive.lock')) as acquired:
+        archive = read_snapshot(metrics_file=archive_file)
+        totals = merge_snapshot(totals={}, snapshot=archive)
+        archived = False
+        for metrics_file in glob(os.path.join(metrics_dir, '*.json')):
+            pid = os.path.basename(metrics_file).split('.')[0]
+            if not pid.isdigit():
+                continue
+            snapshot = read_snapshot(metrics_file=metrics_file)
+            alive = int(pid) == os.getpid() or process_alive(int(pid))
+            # gauges of exited workers are dropped, their counters are moved into the archive
+            merge_snapshot(totals=totals, snapshot=snapshot, include_gauges=alive)
+            if not alive and acquired:
+                merge_snapshot(totals=archive, snapshot=snapshot, include_gauges=False)
+                os.remove(metrics_file)
+                archived = True
+        if archived:
+            write_snapshot(metrics_file=archive_file, snapshot=archive)
+    return totals
+
+
+def format_labels(label_names, key, extra=None):
+    '''metrics.format_labels(label_names, key, extra=None)'''
+    pairs = list(zip(label_names, key))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{{{}}}'.format(','.join('{}="{}"'.format(
+        name,
+        str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    ) for name, value in pairs))
+
+
+def format_value(value):
+    '''metrics.format_value(value)'''
+    if isinstance(value, float) and not value.is_integer():
+        return repr(value)
+    return str(int(value))
+
+
+def render(totals):
+    '''metrics.render(totals)'''
+    lines = []
+    for metric in registry.metrics:
+        lines.append('# HELP {} {}'.format(metric.name, metric.documentation))
+        lines.append('# TYPE {} {}'.format(metric.name, metric.type_name))
+        for key, value in sorted(totals.get(metric.name, {}).items()):
+            key = json.loads(key)
+            if metric.type_name != 'histogram':
+                lines.append('{}{} {}'.format(metric.name, format_labels(metric.label_names, key), format_value(value)))
+                continue
+            cumulative = 0
+            for bound, count in zip(metric.buckets + ('+Inf',), value['buckets']):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    metric.name,
+                    format_labels(metric.label_names, key, extra=('le', bound)),
+                    cumulative
+                ))
+            lines.append('{}_sum{} {}'.format(metric.name, format_labels(metric.label_names, key), repr(value['sum'])))
+            lines.append('{}_count{} {}'.format(metric.name, format_labels(metric.label_names, key), value['count']))
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_dir(app):
+    '''metrics.metrics_dir(app)'''
+    return os.path.join(app.config['CACHE_DIR'], 'metrics')
+
+
+def init_app(app):
+    '''metrics.init_app(app)'''
+    if app.config['METRICS_TOKEN'] is None:
+        return
+
+    @atexit.register
+    def export_at_exit():
+        '''metrics.export_at_exit()'''
+        try:
+            registry.export(metrics_dir=metrics_dir(app))
+        except Exception:
+            app.logger.exception('Failed to export metrics at exit')
@@ -4,20 +4,53 @@
 
 import os
 import io
-import operator
-from shutil import copyfile
 from datetime import datetime, timedelta
+from collections import namedtuple
+from threading import RLock
 from secrets import token_urlsafe
-from functools import reduce
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from sqlalchemy.sql.expression import FunctionElement
+from sqlalchemy.ext.compiler import compiles
 from werkzeug.routing import BuildError
-from flask import current_app, url_for
+from flask import current_app, url_for, g, has_request_context
 from flask_login import UserMixin, AnonymousUserMixin
 from app import db, login_manager
-from app.utils import makedirs
+from app.utils import makedirs, materialize_file
+from app.utils import read_version, bump_version
 from app.utils import date_now, date_then
 from app.utils import CSVReader, CSVWriter, load_yaml
 from app.utils import get_video_duration, format_duration
+from app.utils import y_system_api_request, y_system_client, verify_data_keys
 from app.utils import to_pinyin
+from app.hls import file_stamp, ladder_signature, lower_priority, package_video
+from app.punches import punch_buffer
+
+
+class interval_seconds(FunctionElement):
+    '''models.interval_seconds(FunctionElement)'''
+    type = db.Float()
+    name = 'interval_seconds'
+
+
+@compiles(interval_seconds)
+def compile_interval_seconds(element, compiler, **kw):
+    '''models.compile_interval_seconds(element, compiler, **kw)'''
+    # db.Interval is stored as a datetime offset from the epoch where there is no native interval type
+    return '((julianday({}) - 2440587.5) * 86400.0)'.format(compiler.process(element.clauses, **kw))
+
+
+@compiles(interval_seconds, 'mysql')
+def compile_interval_seconds_mysql(element, compiler, **kw):
+    '''models.compile_interval_seconds_mysql(element, compiler, **kw)'''
+    return '(TIMESTAMPDIFF(MICROSECOND, \'1970-01-01 00:00:00\', {}) / 1000000.0)'.format(
+        compiler.process(element.clauses, **kw)
+    )
+
+
+@compiles(interval_seconds, 'postgresql')
+def compile_interval_seconds_postgresql(element, compiler, **kw):
+    '''models.compile_interval_seconds_postgresql(element, compiler, **kw)'''
+    return 'EXTRACT(EPOCH FROM {})'.format(compiler.process(element.clauses, **kw))
 
 
 class RolePermission(db.Model):
@@ -169,6 +202,109 @@ class Role(db.Model):
         return '<Role {}>'.format(self.name)
 
 
+RoleEntry = namedtuple('RoleEntry', ['id', 'name', 'category', 'level'])
+
+
+class RoleCache:
+    '''models.RoleCache'''
+
+    def __init__(self):
+        self.lock = RLock()
+        self.version = None
+        self.roles = None
+        self.role_ids = None
+        self.permissions = None
+
+    @property
+    def version_file(self):
+        '''RoleCache.version_file(self)'''
+        return os.path.join(current_app.config['CACHE_DIR'], 'roles.version')
+
+    def invalidate(self):
+        '''RoleCache.invalidate(self)'''
+        with self.lock:
+            self.roles = None
+            self.role_ids = None
+            self.permissions = None
+
+    def validate(self):
+        '''RoleCache.validate(self)'''
+        # roles may be changed by another process (e.g. manage.py deploy): check once per request
+        if has_request_context():
+            if g.get('role_cache_validated', False):
+                return
+            g.role_cache_validated = True
+        version = read_version(version_file=self.version_file)
+        if version != self.version:
+            self.invalidate()
+            self.version = version
+
+    def load(self):
+        '''RoleCache.load(self)'''
+        self.validate()
+        with self.lock:
+            if self.roles is None:
+                roles = {role.id: RoleEntry(
+                    id=role.id,
+                    name=role.name,
+                    category=role.category,
+                    level=role.level
+                ) for role in Role.query.all()}
+                permissions = {role_id: set() for role_id in roles}
+                for role_id, permission_name in db.session.query(RolePermission.role_id, Permission.name)\
+                    .join(Permission, Permission.id == RolePermission.permission_id):
+                    permissions.setdefault(role_id, set()).add(permission_name)
+                self.permissions = {role_id: frozenset(names) for role_id, names in permissions.items()}
+                self.role_ids = {role.name: role.id for role in roles.values()}
+                self.roles = roles
+            return self.roles, self.role_ids, self.permissions
+
+    def role(self, role_id):
+        '''RoleCache.role(self, role_id)'''
+        roles, role_ids, permissions = self.load()
+        return roles.get(role_id)
+
+    def role_named(self, role_name):
+        '''RoleCache.role_named(self, role_name)'''
+        roles, role_ids, permissions = self.load()
+        return roles.get(role_ids.get(role_name))
+
+    def has_permission(self, role_id, permission_name):
+        '''RoleCache.has_permission(self, role_id, permission_name)'''
+        roles, role_ids, permissions = self.load()
+        return permission_name in permissions.get(role_id, ())
+
+    @staticmethod
+    def on_changed_entry(mapper, connection, target):
+        '''RoleCache.on_changed_entry(mapper, connection, target)'''
+        role_cache.invalidate()
+        session = db.object_session(target)
+        if session is not None:
+            session.info['role_cache_changed'] = True
+
+    @staticmethod
+    def on_session_commit(session):
+        '''RoleCache.on_session_commit(session)'''
+        if session.info.pop('role_cache_changed', False):
+            role_cache.invalidate()
+            role_cache.version = bump_version(version_file=role_cache.version_file)
+
+    @staticmethod
+    def on_session_rollback(session, previous_transaction):
+        '''RoleCache.on_session_rollback(session, previous_transaction)'''
+        if session.info.pop('role_cache_changed', False):
+            role_cache.invalidate()
+
+
+role_cache = RoleCache()
+
+for model in (Role, Permission, RolePermission):
+    for event_name in ('after_insert', 'after_update', 'after_delete'):
+        db.event.listen(model, event_name, RoleCache.on_changed_entry)
+db.event.listen(db.session, 'after_commit', RoleCache.on_session_commit)
+db.event.listen(db.session, 'after_soft_rollback', RoleCache.on_session_rollback)
+
+
 class Punch(db.Model):
     '''Table: punches'''
     __tablename__ = 'punches'
@@ -180,15 +316,20 @@ class Punch(db.Model):
 
     def set_synchronized(self):
         '''Punch.set_synchronized(self)'''
+        # the timestamp orders buffered play time updates (punches.write_punches): it is left alone
         if self.video.lesson.type.name == 'VB':
             self.synchronized = True
-            self.timestamp = datetime.utcnow()
             db.session.add(self)
         elif self.video.lesson.type.name in ['Y-GRE', 'Y-GRE AW']:
             for video in Video.query\
                 .filter(Video.lesson_id == self.video.lesson_id)\
                 .all():
-                self.user.punch(video=video, synchronized=True)
+                punch = self.user.get_punch(video=video)
+                if punch is None:
+                    punch = Punch(user_id=self.user_id, video_id=video.id)
+                punch.synchronized = True
+                db.session.add(punch)
+            self.user.reset_progress_snapshot()
 
     @property
     def sync_required(self):
@@ -291,6 +432,174 @@ class Punch(db.Model):
         return '<Punch {} {} {}>'.format(self.user.name, self.video.name, self.play_time)
 
 
+LessonProgress = namedtuple('LessonProgress', ['play_time', 'duration', 'progress', 'progress_percentage'])
+StatusEntry = namedtuple('StatusEntry', ['user', 'latest_punch', 'last_vb_video', 'last_y_gre_video', 'device'])
+
+
+class ProgressSnapshot:
+    '''models.ProgressSnapshot'''
+
+    def __init__(self, user_id):
+        self.videos = {}
+        self.lessons = {}
+        self.lesson_types = {}
+        for video_id, duration, lesson_id, progress_threshold, type_id, type_name in db.session\
+            .query(Video.id, Video.duration, Lesson.id, Lesson.progress_threshold, LessonType.id, LessonType.name)\
+            .join(Lesson, Lesson.id == Video.lesson_id)\
+            .join(LessonType, LessonType.id == Lesson.type_id)\
+            .order_by(Video.id.asc()):
+            self.videos[video_id] = {
+                'duration': duration,
+                'lesson_id': lesson_id,
+                'type_id': type_id,
+                'play_time': None,
+            }
+            lesson = self.lessons.setdefault(lesson_id, {
+                'duration': timedelta(),
+                'play_time': timedelta(),
+                'progress_threshold': progress_threshold,
+                'type_id': type_id,
+            })
+            lesson['duration'] += duration
+            self.lesson_types[type_id] = type_name
+        play_times = dict(db.session.query(Punch.video_id, Punch.play_time)\
+            .filter(Punch.user_id == user_id)\
+            .all())
+        # punches waiting in this process's write-behind buffer are newer than the database,
+        # other processes never buffer a punch which changes what may be played/studied
+        buffer = punch_buffer()
+        if buffer is not None:
+            play_times.update(buffer.pending_play_times(user_id=user_id))
+        for video_id, play_time in play_times.items():
+            video = self.videos.get(video_id)
+            if video is not None:
+                video['play_time'] = play_time
+                self.lessons[video['lesson_id']]['play_time'] += min(play_time, video['duration'])
+        # the first incomplete video/lesson of each type bounds what may be played/studied
+        self.first_incomplete_videos = {}
+        for video_id, video in self.videos.items():
+            if video['type_id'] not in self.first_incomplete_videos and \
+                not self.video_progress(video_id) >= self.lessons[video['lesson_id']]['progress_threshold']:
+                self.first_incomplete_videos[video['type_id']] = video_id
+        self.first_incomplete_lessons = {}
+        for lesson_id in sorted(self.lessons):
+            lesson = self.lessons[lesson_id]
+            if lesson['type_id'] not in self.first_incomplete_lessons and \
+                not self.lesson_progress(lesson_id) >= lesson['progress_threshold']:
+                self.first_incomplete_lessons[lesson['type_id']] = lesson_id
+
+    def type_name(self, type_id):
+        '''ProgressSnapshot.type_name(self, type_id)'''
+        return self.lesson_types.get(type_id)
+
+    def punched(self, video_id):
+        '''ProgressSnapshot.punched(self, video_id)'''
+        video = self.videos.get(video_id)
+        return video is not None and video['play_time'] is not None
+
+    def video_play_time(self, video_id):
+        '''ProgressSnapshot.video_play_time(self, video_id)'''
+        video = self.videos.get(video_id)
+        if video is None or video['play_time'] is None:
+            return timedelta()
+        return video['play_time']
+
+    def video_progress(self, video_id):
+        '''ProgressSnapshot.video_progress(self, video_id)'''
+        video = self.videos.get(video_id)
+        if video is None or video['play_time'] is None:
+            return 0.0
+        if video['play_time'] >= video['duration']:
+            return 1.0
+        return video['play_time'] / video['duration']
+
+    def lesson_play_time(self, lesson_id):
+        '''ProgressSnapshot.lesson_play_time(self, lesson_id)'''
+        lesson = self.lessons.get(lesson_id)
+        if lesson is None:
+            return timedelta()
+        return lesson['play_time']
+
+    def lesson_progress(self, lesson_id):
+        '''ProgressSnapshot.lesson_progress(self, lesson_id)'''
+        lesson = self.lessons.get(lesson_id)
+        if lesson is None:
+            return 0.0
+        return lesson['play_time'] / lesson['duration']
+
+    def can_play(self, video_id, type_id):
+        '''ProgressSnapshot.can_play(self, video_id, type_id)'''
+        first_incomplete_video_id = self.first_incomplete_videos.get(type_id)
+        return first_incomplete_video_id is None or video_id <= first_incomplete_video_id
+
+    def can_study(self, lesson_id, type_id):
+        '''ProgressSnapshot.can_study(self, lesson_id, type_id)'''
+        first_incomplete_lesson_id = self.first_incomplete_lessons.get(type_id)
+        return first_incomplete_lesson_id is None or lesson_id <= first_incomplete_lesson_id
+
+
+class LessonProgress:
+    '''models.LessonProgress'''
+
+    def __init__(self, user_id, lesson):
+        self.progress_threshold = lesson.progress_threshold
+        self.videos = {}
+        buffer = punch_buffer()
+        for video_id, duration, play_time in db.session\
+            .query(Video.id, Video.duration, Punch.play_time)\
+            .outerjoin(Punch, db.and_(Punch.video_id == Video.id, Punch.user_id == user_id))\
+            .filter(Video.lesson_id == lesson.id):
+            if buffer is not None:
+                # punches waiting in this process's write-behind buffer are newer than the database
+                pending_play_time = buffer.pending_play_time(user_id=user_id, video_id=video_id)
+                if pending_play_time is not None:
+                    play_time = pending_play_time
+            self.videos[video_id] = {
+                'duration': duration,
+                'play_time': play_time,
+            }
+
+    def punched(self, video_id):
+        '''LessonProgress.punched(self, video_id)'''
+        video = self.videos.get(video_id)
+        return video is not None and video['play_time'] is not None
+
+    def video_progress(self, video_id):
+        '''LessonProgress.video_progress(self, video_id)'''
+        video = self.videos.get(video_id)
+        if video is None or video['play_time'] is None:
+            return 0.0
+        if video['play_time'] >= video['duration']:
+            return 1.0
+        return video['play_time'] / video['duration']
+
+    def lesson_progress(self):
+        '''LessonProgress.lesson_progress(self)'''
+        duration = sum((video['duration'] for video in self.videos.values()), timedelta())
+        play_time = sum((min(video['play_time'], video['duration']) for video in self.videos.values() \
+            if video['play_time'] is not None), timedelta())
+        return play_time / duration
+
+    def milestones(self, video_id):
+        '''LessonProgress.milestones(self, video_id)'''
+        return (
+            self.video_progress(video_id=video_id) >= 1.0,
+            self.video_progress(video_id=video_id) >= self.progress_threshold,
+            self.lesson_progress() >= self.progress_threshold,
+        )
+
+    def record(self, video_id, play_time):
+        '''LessonProgress.record(self, video_id, play_time)'''
+        # whether the punch completes a video, or reaches the progress threshold of the video/lesson
+        if video_id not in self.videos:
+            return True
+        if not isinstance(play_time, timedelta):
+            play_time = timedelta(seconds=play_time)
+        previous_milestones = self.milestones(video_id=video_id)
+        self.videos[video_id]['play_time'] = play_time
+        return self.milestones(video_id=video_id) != previous_milestones
+
+
 class User(UserMixin, db.Model):
     '''models.User(UserMixin, db.Model)'''
     __tablename__ = 'users'
@@ -355,44 +664,43 @@ class User(UserMixin, db.Model):
         '''User.can(self, permission_name)'''
         if self.suspended:
             return False
-        permission = Permission.query.filter_by(name=permission_name).first()
-        return permission is not None and \
-            self.role_id is not None and \
-            self.role.has_permission(permission=permission)
+        return self.role_id is not None and \
+            role_cache.has_permission(role_id=self.role_id, permission_name=permission_name)
 
     def plays(self, role_name):
         '''User.plays(self, role_name)'''
         if self.suspended:
             return False
-        role = Role.query.filter_by(name=role_name).first()
+        role = role_cache.role_named(role_name=role_name)
+        own_role = role_cache.role(role_id=self.role_id)
         return role is not None and \
-            self.role_id is not None and \
-            (self.role_id == role.id or self.role.is_superior_than(role=role))
+            own_role is not None and \
+            (own_role.id == role.id or own_role.level > role.level)
 
     @property
     def is_student(self):
         '''User.is_student(self)'''
-        return not self.suspended and self.role.category == 'student'
+        return not self.suspended and role_cache.role(role_id=self.role_id).category == 'student'
 
     @property
     def is_staff(self):
         '''User.is_staff(self)'''
-        return not self.suspended and self.role.category == 'staff'
+        return not self.suspended and role_cache.role(role_id=self.role_id).category == 'staff'
 
     @property
     def is_moderator(self):
         '''User.is_moderator(self)'''
-        return not self.suspended and self.role.name == '协管员'
+        return not self.suspended and role_cache.role(role_id=self.role_id).name == '协管员'
 
     @property
     def is_administrator(self):
         '''User.is_administrator(self)'''
-        return not self.suspended and self.role.name == '管理员'
+        return not self.suspended and role_cache.role(role_id=self.role_id).name == '管理员'
 
     @property
     def is_developer(self):
         '''User.is_developer(self)'''
-        return not self.suspended and self.role.name == '开发人员'
+        return not self.suspended and role_cache.role(role_id=self.role_id).name == '开发人员'
 
     def is_superior_than(self, user):
         '''User.is_superior_than(self, user)'''
@@ -474,6 +782,7 @@ class User(UserMixin, db.Model):
         if synchronized is not None:
             punch.synchronized = synchronized
         db.session.add(punch)
+        self.reset_progress_snapshot()
 
     def punched(self, video):
         '''User.punched(self, video)'''
@@ -553,17 +862,127 @@ class User(UserMixin, db.Model):
             .order_by(Video.id.desc())\
             .first()
 
+    @property
+    def progress_snapshot(self):
+        '''User.progress_snapshot(self)'''
+        snapshot = self.__dict__.get('_progress_snapshot')
+        if snapshot is None:
+            snapshot = ProgressSnapshot(user_id=self.id)
+            self.__dict__['_progress_snapshot'] = snapshot
+        return snapshot
+
+    def reset_progress_snapshot(self):
+        '''User.reset_progress_snapshot(self)'''
+        self.__dict__.pop('_progress_snapshot', None)
+
+    @staticmethod
+    def status_entries(since, student_only=False):
+        '''User.status_entries(since, student_only=False)'''
+        users = User.query\
+            .options(db.joinedload(User.role))\
+            .filter(User.id.in_(db.session.query(Punch.user_id)\
+                .filter(Punch.timestamp >= since)))
+        if student_only:
+            users = users\
+                .join(Role, Role.id == User.role_id)\
+                .filter(Role.category == 'student')
+        users = users.order_by(User.id.asc()).all()
+        if not users:
+            return []
+        user_ids = [user.id for user in users]
+        # latest punch of each user
+        latest_timestamps = db.session.query(
+                Punch.user_id.label('user_id'),
+                db.func.max(Punch.timestamp).label('timestamp')
+            )\
+            .filter(Punch.user_id.in_(user_ids))\
+            .group_by(Punch.user_id)\
+            .subquery()
+        latest_punches = {punch.user_id: punch for punch in Punch.query\
+            .join(latest_timestamps, db.and_(
+                Punch.user_id == latest_timestamps.c.user_id,
+                Punch.timestamp == latest_timestamps.c.timestamp
+            ))\
+            .options(db.joinedload(Punch.video).joinedload(Video.lesson).joinedload(Lesson.type))\
+            .all()}
+        # furthest VB/Y-GRE video of each user
+        last_video_ids = {}
+        for user_id, type_name, video_id in db.session.query(
+                Punch.user_id,
+                LessonType.name,
+                db.func.max(Punch.video_id)
+            )\
+            .join(Video, Video.id == Punch.video_id)\
+            .join(Lesson, Lesson.id == Video.lesson_id)\
+            .join(LessonType, LessonType.id == Lesson.type_id)\
+            .filter(Punch.user_id.in_(user_ids))\
+            .filter(LessonType.name.in_(['VB', 'Y-GRE']))\
+            .group_by(Punch.user_id, LessonType.name):
+            last_video_ids[(user_id, type_name)] = video_id
+        videos = {}
+        if last_video_ids:
+            videos = {video.id: video for video in Video.query\
+                .filter(Video.id.in_(set(last_video_ids.values())))\
+                .options(db.joinedload(Video.lesson).joinedload(Lesson.type))\
+                .all()}
+        # login devices
+        devices = {}
+        mac_addresses = {user.last_seen_mac for user in users if user.last_seen_mac is not None}
+        if mac_addresses:
+            for device in Device.query\
+                .filter(Device.mac_address.in_(mac_addresses))\
+                .options(db.joinedload(Device.room), db.joinedload(Device.type))\
+                .order_by(Device.id.desc()):
+                devices[device.mac_address] = device
+        return [StatusEntry(
+            user=user,
+            latest_punch=latest_punches.get(user.id),
+            last_vb_video=videos.get(last_video_ids.get((user.id, 'VB'))),
+            last_y_gre_video=videos.get(last_video_ids.get((user.id, 'Y-GRE'))),
+            device=devices.get(user.last_seen_mac)
+        ) for user in users]
+
+    def lesson_progress_entries(self, lesson_ids=None):
+        '''User.lesson_progress_entries(self, lesson_ids=None)'''
+        video_seconds = interval_seconds(Video.duration)
+        punch_seconds = interval_seconds(Punch.play_time)
+        query = db.session.query(
+                Video.lesson_id,
+                db.func.sum(video_seconds),
+                db.func.sum(db.case(
+                    [
+                        (Punch.play_time == None, 0.0),
+                        (punch_seconds >= video_seconds, video_seconds),
+                    ],
+                    else_=punch_seconds
+                ))
+            )\
+            .outerjoin(Punch, db.and_(
+                Punch.video_id == Video.id,
+                Punch.user_id == self.id
+            ))
+        if lesson_ids is not None:
+            query = query.filter(Video.lesson_id.in_(lesson_ids))
+        entries = {}
+        for lesson_id, duration, play_time in query.group_by(Video.lesson_id):
+            duration = duration or 0.0
+            play_time = play_time or 0.0
+            progress = play_time / duration if duration > 0 else 0.0
+            entries[lesson_id] = LessonProgress(
+                play_time=timedelta(seconds=round(play_time, 3)),
+                duration=timedelta(seconds=round(duration, 3)),
+                progress=progress,
+                progress_percentage='{:.0%}'.format(progress)
+            )
+        return entries
+
     def lesson_play_time(self, lesson):
         '''User.lesson_play_time(self, lesson)'''
-        return reduce(operator.add, [punch.play_time_trim for punch in Punch.query\
-            .join(Video, Video.id == Punch.video_id)\
-            .filter(Video.lesson_id == lesson.id)\
-            .filter(Punch.user_id == self.id)\
-            .all()], timedelta())
+        return self.progress_snapshot.lesson_play_time(lesson_id=lesson.id)
 
     def lesson_progress(self, lesson):
         '''User.lesson_progress(self, lesson)'''
-        return self.lesson_play_time(lesson=lesson) / lesson.duration
+        return self.progress_snapshot.lesson_progress(lesson_id=lesson.id)
 
     def lesson_progress_percentage(self, lesson):
         '''User.lesson_progress_percentage(self, lesson)'''
@@ -577,29 +996,18 @@ class User(UserMixin, db.Model):
 
     def can_study(self, lesson):
         '''User.can_study(self, lesson)'''
-        if lesson.type.name in ['VB', 'Y-GRE', 'Y-GRE AW']:
+        if self.progress_snapshot.type_name(type_id=lesson.type_id) in ['VB', 'Y-GRE', 'Y-GRE AW']:
             return self.plays(role_name='协调员') or \
-                reduce(operator.and_, [self.complete_lesson(lesson=lesson) \
-                    for lesson in Lesson.query\
-                    .join(LessonType, LessonType.id == Lesson.type_id)\
-                    .filter(Lesson.type_id == lesson.type_id)\
-                    .filter(Lesson.id < lesson.id)\
-                    .all()], True)
+                self.progress_snapshot.can_study(lesson_id=lesson.id, type_id=lesson.type_id)
         return True
 
     def video_play_time(self, video):
         '''User.video_play_time(self, video)'''
-        punch = self.get_punch(video=video)
-        if punch is not None:
-            return punch.play_time
-        return timedelta()
+        return self.progress_snapshot.video_play_time(video_id=video.id)
 
     def video_progress(self, video):
         '''User.video_progress(self, video)'''
-        punch = self.get_punch(video=video)
-        if punch is not None:
-            return punch.progress_trim
-        return 0.0
+        return self.progress_snapshot.video_progress(video_id=video.id)
 
     def video_progress_percentage(self, video):
         '''User.video_progress_percentage(self, video)'''
@@ -613,14 +1021,12 @@ class User(UserMixin, db.Model):
 
     def can_play(self, video):
         '''User.can_play(self, video)'''
-        if video.lesson.type.name == 'VB':
+        type_id = self.progress_snapshot.videos.get(video.id, {}).get('type_id')
+        type_name = self.progress_snapshot.type_name(type_id=type_id)
+        if type_name == 'VB':
             return self.plays(role_name='协调员') or \
-                reduce(operator.and_, [self.complete_video(video=item) for item in Video.query\
-                    .join(Lesson, Lesson.id == Video.lesson_id)\
-                    .filter(Lesson.type_id == video.lesson.type_id)\
-                    .filter(Video.id < video.id)\
-                    .all()], True)
-        if video.lesson.type.name in ['Y-GRE', 'Y-GRE AW']:
+                self.progress_snapshot.can_play(video_id=video.id, type_id=type_id)
+        if type_name in ['Y-GRE', 'Y-GRE AW']:
             return self.can_study(lesson=video.lesson)
         return True
 
@@ -887,7 +1293,7 @@ class Device(db.Model):
     alias = db.Column(db.Unicode(64))
     type_id = db.Column(db.Integer, db.ForeignKey('device_types.id'))
     room_id = db.Column(db.Integer, db.ForeignKey('rooms.id'))
-    mac_address = db.Column(db.Unicode(64))
+    mac_address = db.Column(db.Unicode(64), index=True)
     category = db.Column(db.Unicode(64), default='production', index=True)
     obsolete = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -1103,6 +1509,110 @@ class LessonType(db.Model):
         return '<Lesson Type {}>'.format(self.name)
 
 
+class DeviceEntry(namedtuple('DeviceEntry', ['id', 'alias', 'mac_address', 'lesson_type_ids', 'lesson_type_names'])):
+    '''models.DeviceEntry'''
+
+    def can_access_lesson_type(self, lesson_type):
+        '''DeviceEntry.can_access_lesson_type(self, lesson_type)'''
+        if isinstance(lesson_type, str):
+            return lesson_type in self.lesson_type_names
+        return lesson_type is not None and lesson_type.id in self.lesson_type_ids
+
+
+class DeviceIndex:
+    '''models.DeviceIndex'''
+
+    def __init__(self):
+        self.lock = RLock()
+        self.version = None
+        self.devices = None
+
+    @property
+    def version_file(self):
+        '''DeviceIndex.version_file(self)'''
+        return os.path.join(current_app.config['CACHE_DIR'], 'devices.version')
+
+    def invalidate(self):
+        '''DeviceIndex.invalidate(self)'''
+        with self.lock:
+            self.devices = None
+
+    def validate(self):
+        '''DeviceIndex.validate(self)'''
+        # devices may be changed by another process: check once per request
+        if has_request_context():
+            if g.get('device_index_validated', False):
+                return
+            g.device_index_validated = True
+        version = read_version(version_file=self.version_file)
+        if version != self.version:
+            self.invalidate()
+            self.version = version
+
+    def load(self):
+        '''DeviceIndex.load(self)'''
+        self.validate()
+        with self.lock:
+            if self.devices is None:
+                lesson_types = {}
+                for device_id, lesson_type_id, lesson_type_name in db.session.query(
+                    DeviceLessonType.device_id,
+                    LessonType.id,
+                    LessonType.name
+                ).join(LessonType, LessonType.id == DeviceLessonType.lesson_type_id):
+                    lesson_types.setdefault(device_id, []).append((lesson_type_id, lesson_type_name))
+                devices = {}
+                for device_id, alias, mac_address in db.session.query(Device.id, Device.alias, Device.mac_address)\
+                    .filter(Device.mac_address != None)\
+                    .order_by(Device.id.asc()):
+                    # the first device registered with a MAC address wins
+                    devices.setdefault(mac_address, DeviceEntry(
+                        id=device_id,
+                        alias=alias,
+                        mac_address=mac_address,
+                        lesson_type_ids=frozenset(item[0] for item in lesson_types.get(device_id, [])),
+                        lesson_type_names=frozenset(item[1] for item in lesson_types.get(device_id, []))
+                    ))
+                self.devices = devices
+            return self.devices
+
+    def device(self, mac_address):
+        '''DeviceIndex.device(self, mac_address)'''
+        if mac_address is None:
+            return None
+        return self.load().get(mac_address)
+
+    @staticmethod
+    def on_changed_entry(mapper, connection, target):
+        '''DeviceIndex.on_changed_entry(mapper, connection, target)'''
+        device_index.invalidate()
+        session = db.object_session(target)
+        if session is not None:
+            session.info['device_index_changed'] = True
+
+    @staticmethod
+    def on_session_commit(session):
+        '''DeviceIndex.on_session_commit(session)'''
+        if session.info.pop('device_index_changed', False):
+            device_index.invalidate()
+            device_index.version = bump_version(version_file=device_index.version_file)
+
+    @staticmethod
+    def on_session_rollback(session, previous_transaction):
+        '''DeviceIndex.on_session_rollback(session, previous_transaction)'''
+        if session.info.pop('device_index_changed', False):
+            device_index.invalidate()
+
+
+device_index = DeviceIndex()
+
+for model in (Device, DeviceLessonType, LessonType):
+    for event_name in ('after_insert', 'after_update', 'after_delete'):
+        db.event.listen(model, event_name, DeviceIndex.on_changed_entry)
+db.event.listen(db.session, 'after_commit', DeviceIndex.on_session_commit)
+db.event.listen(db.session, 'after_soft_rollback', DeviceIndex.on_session_rollback)
+
+
 class Lesson(db.Model):
     '''models.Lesson(db.Model)'''
     __tablename__ = 'lessons'
@@ -1111,12 +1621,86 @@ class Lesson(db.Model):
     abbr = db.Column(db.Unicode(64))
     type_id = db.Column(db.Integer, db.ForeignKey('lesson_types.id'))
     progress_threshold = db.Column(db.Float, default=0.0)
+    duration = db.Column(db.Interval, default=timedelta())
     videos = db.relationship('Video', backref='lesson', lazy='dynamic')
 
-    @property
-    def duration(self):
-        '''Lesson.duration(self)'''
-        return reduce(operator.add, [video.duration for video in self.videos], timedelta())
+    @staticmethod
+    def refresh_durations(verbose=False):
+        '''Lesson.refresh_durations(verbose=False)'''
+        durations = {}
+        for lesson_id, duration in db.session.query(Video.lesson_id, Video.duration):
+            durations[lesson_id] = durations.get(lesson_id, timedelta()) + duration
+        count = 0
+        for lesson in Lesson.query.order_by(Lesson.id.asc()).all():
+            duration = durations.get(lesson.id, timedelta())
+            if lesson.duration != duration:
+                if verbose:
+                    print('更新课程时长', lesson.name, lesson.duration, '->', duration)
+                lesson.duration = duration
+                db.session.add(lesson)
+                count += 1
+        db.session.commit()
+        return count
+
+    @staticmethod
+    def mark_duration_changed(target, lesson_ids):
+        '''Lesson.mark_duration_changed(target, lesson_ids)'''
+        session = db.object_session(target)
+        if session is None:
+            return
+        session.info.setdefault('lesson_duration_changes', set())\
+            .update(lesson_id for lesson_id in lesson_ids if lesson_id is not None)
+
+    @staticmethod
+    def stored_lesson_id(connection, target):
+        '''Lesson.stored_lesson_id(connection, target)'''
+        # the loaded value is unknown when the attribute was expired (e.g. after a commit)
+        return connection.execute(db.select([Video.__table__.c.lesson_id])\
+            .where(Video.__table__.c.id == target.id)).scalar()
+
+    @staticmethod
+    def on_inserted_video(mapper, connection, target):
+        '''Lesson.on_inserted_video(mapper, connection, target)'''
+        Lesson.mark_duration_changed(target=target, lesson_ids=[target.lesson_id])
+
+    @staticmethod
+    def on_updated_video(mapper, connection, target):
+        '''Lesson.on_updated_video(mapper, connection, target)'''
+        attributes = db.inspect(target).attrs
+        history = attributes.lesson_id.history
+        if history.has_changes() or attributes.duration.history.has_changes():
+            # the previous lesson is read before the row is updated
+            Lesson.mark_duration_changed(
+                target=target,
+                lesson_ids=[Lesson.stored_lesson_id(connection=connection, target=target)] + \
+                    list(history.added or ()) + list(history.unchanged or ())
+            )
+
+    @staticmethod
+    def on_deleted_video(mapper, connection, target):
+        '''Lesson.on_deleted_video(mapper, connection, target)'''
+        Lesson.mark_duration_changed(
+            target=target,
+            lesson_ids=[Lesson.stored_lesson_id(connection=connection, target=target)]
+        )
+
+    @staticmethod
+    def on_session_flush(session, flush_context):
+        '''Lesson.on_session_flush(session, flush_context)'''
+        lesson_ids = session.info.pop('lesson_duration_changes', None)
+        if not lesson_ids:
+            return
+        durations = {lesson_id: timedelta() for lesson_id in lesson_ids}
+        for lesson_id, duration in session.execute(db.select([Video.__table__.c.lesson_id, Video.__table__.c.duration])\
+            .where(Video.__table__.c.lesson_id.in_(lesson_ids))):
+            durations[lesson_id] += duration
+        for lesson_id, duration in durations.items():
+            session.execute(Lesson.__table__.update()\
+                .where(Lesson.__table__.c.id == lesson_id)\
+                .values(duration=duration))
+            lesson = session.identity_map.get(db.inspect(Lesson).identity_key_from_primary_key([lesson_id]))
+            if lesson is not None:
+                session.expire(lesson, ['duration'])
 
     @property
     def duration_format(self):
@@ -1159,6 +1743,10 @@ class Video(db.Model):
     duration = db.Column(db.Interval, default=timedelta())
     file_name = db.Column(db.Unicode(64))
     hls_cache_file_name = db.Column(db.Unicode(64))
+    hls_package_hash = db.Column(db.Unicode(64))
+    hls_package_stamp = db.Column(db.Unicode(64))
+    hls_package_status = db.Column(db.Unicode(64), default='pending')
+    hls_packaged_at = db.Column(db.DateTime)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     punches = db.relationship(
         'Punch',
@@ -1185,15 +1773,53 @@ class Video(db.Model):
     @property
     def hls_url(self):
         '''Video.hls_url(self)'''
-        if self.hls_cache_invalid:
-            self.refresh_hls_cache()
-            db.session.commit()
         return '/hls/{}/index.m3u8'.format(self.hls_cache_file_name)
 
+    @property
+    def hls_package_dir(self):
+        '''Video.hls_package_dir(self)'''
+        if self.hls_package_hash is None:
+            return None
+        return os.path.join(
+            current_app.config['HLS_SEGMENT_DIR'],
+            self.hls_package_hash,
+            ladder_signature(
+                renditions=current_app.config['HLS_RENDITIONS'],
+                segment_duration=current_app.config['HLS_SEGMENT_DURATION']
+            )
+        )
+
+    @property
+    def hls_packaged(self):
+        '''Video.hls_packaged(self)'''
+        return current_app.config['HLS_PACKAGING'] and \
+            self.hls_package_status == 'ready' and \
+            os.path.exists(os.path.join(self.hls_package_dir, 'index.m3u8'))
+
+    @property
+    def hls_package_status_name(self):
+        '''Video.hls_package_status_name(self)'''
+        return {
+            'pending': '待切片',
+            'packaging': '切片中',
+            'ready': '已切片',
+            'failed': '切片失败',
+        }.get(self.hls_package_status, self.hls_package_status)
+
+    @property
+    def hls_cache_current(self):
+        '''Video.hls_cache_current(self)'''
+        hls_cache_file = os.path.join(current_app.config['HLS_DIR'], self.hls_cache_file_name)
+        if not os.path.exists(hls_cache_file):
+            return False
+        if self.hls_packaged:
+            return os.path.realpath(hls_cache_file) == os.path.realpath(self.hls_package_dir)
+        return os.path.isfile(hls_cache_file)
+
     @property
     def hls_cache_invalid(self):
         '''Video.hls_cache_invalid(self)'''
-        return not os.path.exists(os.path.join(current_app.config['HLS_DIR'], self.hls_cache_file_name)) or \
+        return not self.hls_cache_current or \
             date_then(timestamp=self.timestamp, utc_offset=current_app.config['UTC_OFFSET']) != \
             date_now(utc_offset=current_app.config['UTC_OFFSET'])
 
@@ -1201,15 +1827,110 @@ class Video(db.Model):
         '''Video.refresh_hls_cache(self)'''
         makedirs(path=current_app.config['HLS_DIR'])
         hls_cache_file = os.path.join(current_app.config['HLS_DIR'], self.hls_cache_file_name)
-        new_hls_cache_file_name = '{}.mp4'.format(token_urlsafe(16))
+        if self.hls_packaged:
+            # packaged videos are exposed through an alias directory
+            new_hls_cache_file_name = token_urlsafe(16)
+        else:
+            new_hls_cache_file_name = '{}.mp4'.format(token_urlsafe(16))
         new_hls_cache_file = os.path.join(current_app.config['HLS_DIR'], new_hls_cache_file_name)
-        if os.path.exists(hls_cache_file):
+        if self.hls_cache_current:
             os.rename(hls_cache_file, new_hls_cache_file)
         else:
-            copyfile(os.path.join(current_app.config['VIDEO_DIR'], self.file_name), new_hls_cache_file)
+            if os.path.lexists(hls_cache_file):
+                os.remove(hls_cache_file)
+            if self.hls_packaged:
+                os.symlink(self.hls_package_dir, new_hls_cache_file)
+            else:
+                materialize_file(
+                    source=os.path.join(current_app.config['VIDEO_DIR'], self.file_name),
+                    destination=new_hls_cache_file,
+                    strategies=current_app.config['HLS_CACHE_STRATEGIES']
+                )
         self.hls_cache_file_name = new_hls_cache_file_name
         self.timestamp = datetime.utcnow()
         db.session.add(self)
+        return hls_cache_file, new_hls_cache_file
+
+    @staticmethod
+    def refresh_hls_caches(force=False, verbose=False):
+        '''Video.refresh_hls_caches(force=False, verbose=False)'''
+        renamed = []
+        try:
+            for video in Video.query.order_by(Video.id.asc()).all():
+                if force or video.hls_cache_invalid:
+                    renamed.append(video.refresh_hls_cache())
+                    if verbose:
+                        print('更新HLS缓存', video.name, video.hls_cache_file_name)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            # restore the cache files so that they match the stored tokens again
+            for hls_cache_file, new_hls_cache_file in reversed(renamed):
+                if os.path.lexists(new_hls_cache_file) and not os.path.lexists(hls_cache_file):
+                    os.rename(new_hls_cache_file, hls_cache_file)
+            raise
+        return len(renamed)
+
+    @staticmethod
+    def package_hls(workers=None, force=False, verbose=False):
+        '''Video.package_hls(workers=None, force=False, verbose=False)'''
+        segment_dir = current_app.config['HLS_SEGMENT_DIR']
+        makedirs(path=segment_dir)
+        jobs = {}
+        for video in Video.query.order_by(Video.id.asc()).all():
+            video_file = os.path.join(current_app.config['VIDEO_DIR'], video.file_name)
+            if not os.path.exists(video_file):
+                print('视频文件不存在', video.name, video.file_name)
+                continue
+            stamp = file_stamp(video_file)
+            if not force and video.hls_package_stamp == stamp and video.hls_package_status == 'ready' and \
+                os.path.exists(os.path.join(video.hls_package_dir, 'index.m3u8')):
+                if verbose:
+                    print('跳过未更改的视频', video.name)
+                continue
+            video.hls_package_status = 'packaging'
+            db.session.add(video)
+            jobs[video.id] = (video_file, stamp, video.hls_package_hash \
+                if video.hls_package_stamp == stamp and not force else None)
+        db.session.commit()
+        if not jobs:
+            return 0
+        packaged = 0
+        with ProcessPoolExecutor(
+            max_workers=workers or current_app.config['HLS_PACKAGING_WORKERS'],
+            initializer=lower_priority,
+            initargs=(current_app.config['HLS_PACKAGING_NICENESS'],)
+        ) as executor:
+            futures = {executor.submit(
+                package_video,
+                source=video_file,
+                segment_dir=segment_dir,
+                segment_duration=current_app.config['HLS_SEGMENT_DURATION'],
+                ffmpeg=current_app.config['FFMPEG_BINARY'],
+                renditions=current_app.config['HLS_RENDITIONS'],
+                threads=current_app.config['HLS_PACKAGING_THREADS'],
+                content_hash=content_hash,
+                force=force
+            ): video_id for video_id, (video_file, stamp, content_hash) in jobs.items()}
+            for future in as_completed(futures):
+                video = Video.query.get(futures[future])
+                try:
+                    video.hls_package_hash = future.result()
+                except Exception as e:
+                    video.hls_package_status = 'failed'
+                    print('视频切片失败', video.name, e)
+                else:
+                    video.hls_package_stamp = jobs[video.id][1]
+                    video.hls_package_status = 'ready'
+                    video.hls_packaged_at = datetime.utcnow()
+                    packaged += 1
+                    if verbose:
+                        print('视频切片完成', video.name, video.hls_package_hash)
+                    if current_app.config['HLS_ENABLE'] and current_app.config['HLS_PACKAGING']:
+                        video.refresh_hls_cache()
+                db.session.add(video)
+                db.session.commit()
+        return packaged
 
     @staticmethod
     def insert_entries(data, verbose=False):
@@ -1223,7 +1944,11 @@ class Video(db.Model):
                 video_file = os.path.join(current_app.config['VIDEO_DIR'], entry['file_name'])
                 if os.path.exists(video_file):
                     hls_cache_file_name = '{}.mp4'.format(token_urlsafe(16))
-                    copyfile(video_file, os.path.join(current_app.config['HLS_DIR'], hls_cache_file_name))
+                    strategy = materialize_file(
+                        source=video_file,
+                        destination=os.path.join(current_app.config['HLS_DIR'], hls_cache_file_name),
+                        strategies=current_app.config['HLS_CACHE_STRATEGIES']
+                    )
                     video = Video(
                         name='{} {}'.format(entry['lesson_name'], entry['abbr']),
                         abbr=entry['abbr'],
@@ -1235,7 +1960,7 @@ class Video(db.Model):
                     )
                     db.session.add(video)
                     if verbose:
-                        print('导入视频信息', entry['lesson_name'], entry['abbr'], entry['file_name'])
+                        print('导入视频信息', entry['lesson_name'], entry['abbr'], entry['file_name'], strategy)
                 else:
                     print('视频文件不存在', entry['lesson_name'], entry['abbr'], entry['file_name'])
             db.session.commit()
@@ -1246,6 +1971,12 @@ class Video(db.Model):
         return '<Video {}>'.format(self.name)
 
 
+db.event.listen(Video, 'after_insert', Lesson.on_inserted_video)
+db.event.listen(Video, 'before_update', Lesson.on_updated_video)
+db.event.listen(Video, 'before_delete', Lesson.on_deleted_video)
+db.event.listen(db.session, 'after_flush_postexec', Lesson.on_session_flush)
+
+
 class UserLog(db.Model):
     '''models.UserLog(db.Model)'''
     __tablename__ = 'user_logs'
@@ -1321,3 +2052,104 @@ class UserLog(db.Model):
             self.category,
             self.timestamp
         )
+
+
+class SyncTask(db.Model):
+    '''models.SyncTask(db.Model)'''
+    __tablename__ = 'sync_tasks'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), index=True)
+    video_id = db.Column(db.Integer, db.ForeignKey('videos.id'))
+    section = db.Column(db.Unicode(64))
+    attempts = db.Column(db.Integer, default=0)
+    last_error = db.Column(db.UnicodeText)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    user = db.relationship('User')
+    video = db.relationship('Video')
+
+    @staticmethod
+    def enqueue(user, video):
+        '''SyncTask.enqueue(user, video)'''
+        # without Y-System the sync worker is never started: the queue would only grow
+        if current_app.config['YSYS_URI'] is None:
+            return False
+        if SyncTask.query.filter_by(user_id=user.id, video_id=video.id).first() is not None:
+            return False
+        db.session.add(SyncTask(user_id=user.id, video_id=video.id, section=video.section))
+        return True
+
+    def retry_later(self, error):
+        '''SyncTask.retry_later(self, error)'''
+        self.attempts = (self.attempts or 0) + 1
+        self.last_error = error
+        self.next_attempt_at = datetime.utcnow() + timedelta(seconds=min(
+            current_app.config['YSYS_SYNC_RETRY_BASE'] * 2 ** (self.attempts - 1),
+            current_app.config['YSYS_SYNC_RETRY_MAX']
+        ))
+        db.session.add(self)
+
+    @staticmethod
+    def batches(tasks):
+        '''SyncTask.batches(tasks)'''
+        # Y-System marks every VB video / Y-GRE lesson up to a section as studied,
+        # so only the furthest section of each user is sent; Y-GRE AW sections are sent one by one
+        batches = {}
+        for task in tasks:
+            type_name = task.video.lesson.type.name
+            if type_name in ['VB', 'Y-GRE']:
+                key = (task.user_id, type_name)
+            else:
+                key = (task.user_id, task.id)
+            batches.setdefault(key, []).append(task)
+        return [sorted(batch, key=lambda task: task.video_id) for batch in batches.values()]
+
+    @staticmethod
+    def process(batch_size=None, verbose=False):
+        '''SyncTask.process(batch_size=None, verbose=False)'''
+        if batch_size is None:
+            batch_size = current_app.config['YSYS_SYNC_BATCH_SIZE']
+        tasks = SyncTask.query\
+            .filter(SyncTask.next_attempt_at <= datetime.utcnow())\
+            .options(db.joinedload(SyncTask.video).joinedload(Video.lesson).joinedload(Lesson.type))\
+            .order_by(SyncTask.id.asc())\
+            .limit(batch_size)\
+            .all()
+        count = 0
+        breaker = y_system_client().breaker
+        for batch in SyncTask.batches(tasks=tasks):
+            if breaker.rejecting:
+                # Y-System is down: leave the remaining tasks queued for the next run
+                if verbose:
+                    print('Y-System熔断中，暂停同步')
+                break
+            head = batch[-1]
+            data = y_system_api_request(api='punch', token_data={
+                'user_id': head.user_id,
+                'section': head.section,
+            })
+            if verify_data_keys(data=data, keys=['success']):
+                for task in batch:
+                    punch = Punch.query.filter_by(user_id=task.user_id, video_id=task.video_id).first()
+                    if punch is not None:
+                        punch.set_synchronized()
+                    db.session.delete(task)
+                db.session.add(UserLog(
+                    user_id=head.user_id,
+                    event='同步研修进度至Y-System：{}'.format(head.section),
+                    category='study'
+                ))
+                count += len(batch)
+                if verbose:
+                    print('同步研修进度至Y-System', head.user_id, head.section, len(batch))
+            else:
+                error = '网络通信故障' if data is None else str(data.get('error'))
+                for task in batch:
+                    task.retry_later(error=error)
+                if verbose:
+                    print('同步失败', head.user_id, head.section, error)
+            db.session.commit()
+        return count
+
+    def __repr__(self):
+        return '<Sync Task {} {}>'.format(self.user_id, self.section)
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+'''app/presence.py'''
+
+import os
+import atexit
+from threading import Lock
+from datetime import datetime
+from flask import current_app
+from app import db
+
+
+class PresenceTracker:
+    '''presence.PresenceTracker'''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.pid = os.getpid()
+        self.pending = {}
+
+    def record(self, user_id, timestamp=None):
+        '''PresenceTracker.record(self, user_id, timestamp=None)'''
+        if timestamp is None:
+            timestamp = datetime.utcnow()
+        with self.lock:
+            # a forked worker must not flush its parent's presence records
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.pending = {}
+            if self.pending.get(user_id) is None or self.pending[user_id] < timestamp:
+                self.pending[user_id] = timestamp
+
+    def flush(self):
+        '''PresenceTracker.flush(self)'''
+        with self.lock:
+            if self.pid != os.getpid():
+                return 0
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return 0
+        try:
+            write_presence(entries=pending)
+        except Exception:
+            db.session.rollback()
+            for user_id, timestamp in pending.items():
+                self.record(user_id=user_id, timestamp=timestamp)
+            raise
+        return len(pending)
+
+
+def write_presence(entries):
+    '''presence.write_presence(entries)'''
+    from app.models import User
+    users = User.__table__
+    # other worker processes may have written a later timestamp already
+    db.session.execute(users.update()\
+        .where(users.c.id == db.bindparam('user_id'))\
+        .where(db.or_(
+            users.c.last_seen_at.is_(None),
+            users.c.last_seen_at < db.bindparam('timestamp')
+        ))\
+        .values(last_seen_at=db.bindparam('timestamp')), [{
+            'user_id': user_id,
+            'timestamp': timestamp,
+        } for user_id, timestamp in entries.items()])
+    db.session.commit()
+
+
+def presence_tracker():
+    '''presence.presence_tracker()'''
+    return current_app.extensions.get('yvod_presence_tracker')
+
+
+def record_presence(user):
+    '''presence.record_presence(user)'''
+    tracker = presence_tracker()
+    if tracker is None:
+        user.ping()
+        return
+    tracker.record(user_id=user.id)
+
+
+def flush_presence():
+    '''presence.flush_presence()'''
+    tracker = presence_tracker()
+    if tracker is not None:
+        tracker.flush()
+
+
+def init_app(app):
+    '''presence.init_app(app)'''
+    if not app.config['PRESENCE_TRACKER_ENABLE']:
+        return
+    app.extensions['yvod_presence_tracker'] = PresenceTracker()
+
+    @atexit.register
+    def flush_at_exit():
+        '''presence.flush_at_exit()'''
+        with app.app_context():
+            try:
+                flush_presence()
+            except Exception:
+                app.logger.exception('Failed to flush presence at exit')
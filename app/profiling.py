@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+'''app/profiling.py'''
+
+from collections import deque, namedtuple
+from threading import Lock
+from time import perf_counter
+from jinja2 import Template
+from flask import current_app, request, g
+from flask_login import current_user
+from flask_sqlalchemy import get_debug_queries
+from app.utils import add_request_timing
+
+
+RequestSample = namedtuple('RequestSample', ['queries', 'db_time', 'render_time', 'minify_time', 'total_time'])
+
+
+class TimedTemplate(Template):
+    '''profiling.TimedTemplate(Template)'''
+
+    def render(self, *args, **kwargs):
+        start = perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            add_request_timing(name='render', elapsed=perf_counter() - start)
+
+
+def percentile(values, fraction):
+    '''profiling.percentile(values, fraction)'''
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class RequestProfiler:
+    '''profiling.RequestProfiler'''
+
+    def __init__(self, sample_size=200):
+        self.sample_size = sample_size
+        self.lock = Lock()
+        self.samples = {}
+        self.violations = {}
+
+    def record(self, endpoint, sample, over_budget=False):
+        '''RequestProfiler.record(self, endpoint, sample, over_budget=False)'''
+        with self.lock:
+            self.samples.setdefault(endpoint, deque(maxlen=self.sample_size)).append(sample)
+            if over_budget:
+                self.violations[endpoint] = self.violations.get(endpoint, 0) + 1
+
+    def summary(self):
+        '''RequestProfiler.summary(self)'''
+        with self.lock:
+            samples = {endpoint: list(items) for endpoint, items in self.samples.items()}
+            violations = dict(self.violations)
+        summary = {}
+        for endpoint, items in samples.items():
+            entry = {'count': len(items), 'violations': violations.get(endpoint, 0)}
+            for field in RequestSample._fields:
+                values = [getattr(item, field) for item in items]
+                entry[field] = {
+                    'p50': percentile(values, 0.5),
+                    'p95': percentile(values, 0.95),
+                    'max': max(values),
+                }
+            summary[endpoint] = entry
+        return summary
+
+
+def request_profiler():
+    '''profiling.request_profiler()'''
+    return current_app.extensions.get('yvod_request_profiler')
+
+
+def query_budget(endpoint):
+    '''profiling.query_budget(endpoint)'''
+    return current_app.config['PROFILING_QUERY_BUDGETS']\
+        .get(endpoint, current_app.config['PROFILING_QUERY_BUDGET'])
+
+
+def start_request():
+    '''profiling.start_request()'''
+    g.request_started_at = perf_counter()
+
+
+def finish_request(response):
+    '''profiling.finish_request(response)'''
+    profiler = request_profiler()
+    started_at = g.get('request_started_at')
+    if profiler is None or started_at is None or request.endpoint is None:
+        return response
+    queries = get_debug_queries()
+    timings = g.get('request_timings', {})
+    sample = RequestSample(
+        queries=len(queries),
+        db_time=sum(query.duration for query in queries),
+        render_time=timings.get('render', 0.0),
+        minify_time=timings.get('minify', 0.0),
+        total_time=perf_counter() - started_at
+    )
+    budget = query_budget(endpoint=request.endpoint)
+    over_budget = budget is not None and sample.queries > budget
+    if over_budget:
+        current_app.logger.warning('Query budget exceeded: {} ran {} queries (budget: {})'.format(
+            request.endpoint,
+            sample.queries,
+            budget
+        ))
+    profiler.record(endpoint=request.endpoint, sample=sample, over_budget=over_budget)
+    if current_app.config['PROFILING_SERVER_TIMING'] and current_user.is_developer:
+        response.headers['Server-Timing'] = ', '.join([
+            'db;dur={:.1f};desc="{} queries"'.format(sample.db_time * 1000, sample.queries),
+            'render;dur={:.1f}'.format(sample.render_time * 1000),
+            'minify;dur={:.1f}'.format(sample.minify_time * 1000),
+            'total;dur={:.1f}'.format(sample.total_time * 1000),
+        ])
+    return response
+
+
+def init_app(app):
+    '''profiling.init_app(app)'''
+    if not app.config['PROFILING_ENABLE']:
+        return
+    app.jinja_env.template_class = TimedTemplate
+    app.extensions['yvod_request_profiler'] = RequestProfiler(sample_size=app.config['PROFILING_SAMPLE_SIZE'])
+    app.before_request(start_request)
+    app.after_request(finish_request)
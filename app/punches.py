@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+
+'''app/punches.py'''
+
+import os
+import io
+import json
+import atexit
+from glob import glob
+from threading import Lock
+from secrets import token_hex
+from datetime import datetime, timedelta
+from flask import current_app
+from app import db
+from app.utils import makedirs
+
+
+def process_alive(pid):
+    '''punches.process_alive(pid)'''
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class PunchBuffer:
+    '''punches.PunchBuffer'''
+
+    def __init__(self, journal_dir, fsync=True):
+        self.journal_dir = journal_dir
+        self.fsync = fsync
+        self.lock = Lock()
+        self.pid = None
+        self.journal = None
+        self.journal_file = None
+        self.pending = {}
+
+    def open_journal(self):
+        '''PunchBuffer.open_journal(self)'''
+        # a forked worker must not share its parent's journal
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.pending = {}
+            makedirs(path=self.journal_dir)
+            self.journal_file = os.path.join(self.journal_dir, '{}.journal'.format(self.pid))
+            self.journal = io.open(self.journal_file, 'at', encoding='utf-8')
+        return self.journal
+
+    def merge(self, user_id, video_id, play_time, timestamp):
+        '''PunchBuffer.merge(self, user_id, video_id, play_time, timestamp)'''
+        key = (user_id, video_id)
+        entry = self.pending.get(key)
+        if entry is None or entry[1] <= timestamp:
+            self.pending[key] = (play_time, timestamp)
+
+    def record(self, user_id, video_id, play_time):
+        '''PunchBuffer.record(self, user_id, video_id, play_time)'''
+        if isinstance(play_time, timedelta):
+            play_time = play_time.total_seconds()
+        timestamp = datetime.utcnow()
+        with self.lock:
+            journal = self.open_journal()
+            journal.write(json.dumps({
+                'user_id': user_id,
+                'video_id': video_id,
+                'play_time': float(play_time),
+                'timestamp': timestamp.strftime('%Y-%m-%dT%H:%M:%S.%f'),
+            }) + '\n')
+            journal.flush()
+            if self.fsync:
+                os.fsync(journal.fileno())
+            self.merge(user_id=user_id, video_id=video_id, play_time=float(play_time), timestamp=timestamp)
+
+    def discard(self, user_id, video_id):
+        '''PunchBuffer.discard(self, user_id, video_id)'''
+        with self.lock:
+            if self.pid == os.getpid():
+                self.pending.pop((user_id, video_id), None)
+
+    def pending_play_time(self, user_id, video_id):
+        '''PunchBuffer.pending_play_time(self, user_id, video_id)'''
+        with self.lock:
+            if self.pid != os.getpid():
+                return None
+            entry = self.pending.get((user_id, video_id))
+            if entry is None:
+                return None
+            return timedelta(seconds=entry[0])
+
+    def pending_play_times(self, user_id):
+        '''PunchBuffer.pending_play_times(self, user_id)'''
+        with self.lock:
+            if self.pid != os.getpid():
+                return {}
+            return {video_id: timedelta(seconds=play_time) \
+                for (pending_user_id, video_id), (play_time, timestamp) in self.pending.items() \
+                if pending_user_id == user_id}
+
+    def claim_journals(self):
+        '''PunchBuffer.claim_journals(self)'''
+        # take over journals left behind by dead processes and by our own failed flushes
+        claimed = []
+        for journal_file in glob(os.path.join(self.journal_dir, '*.journal')) + \
+            glob(os.path.join(self.journal_dir, '*.flushing')):
+            pid = int(os.path.basename(journal_file).split('.')[0])
+            if pid == self.pid and journal_file == self.journal_file:
+                continue
+            if pid != os.getpid() and process_alive(pid):
+                continue
+            flushing_file = os.path.join(self.journal_dir, '{}.{}.flushing'.format(os.getpid(), token_hex(4)))
+            try:
+                os.rename(journal_file, flushing_file)
+            except FileNotFoundError:
+                continue
+            claimed.append(flushing_file)
+        return claimed
+
+    def replay(self, journal_file):
+        '''PunchBuffer.replay(self, journal_file)'''
+        with io.open(journal_file, 'rt', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    self.merge(
+                        user_id=entry['user_id'],
+                        video_id=entry['video_id'],
+                        play_time=entry['play_time'],
+                        timestamp=datetime.strptime(entry['timestamp'], '%Y-%m-%dT%H:%M:%S.%f')
+                    )
+                except (ValueError, KeyError):
+                    # a torn final line of a crashed process
+                    continue
+
+    def flush(self):
+        '''PunchBuffer.flush(self)'''
+        with self.lock:
+            self.open_journal()
+            journal_files = self.claim_journals()
+            for journal_file in journal_files:
+                self.replay(journal_file=journal_file)
+            if self.pending:
+                # rotate the live journal: it is removed once its punches are committed
+                self.journal.close()
+                flushing_file = os.path.join(self.journal_dir, '{}.{}.flushing'.format(self.pid, token_hex(4)))
+                os.rename(self.journal_file, flushing_file)
+                self.journal = io.open(self.journal_file, 'at', encoding='utf-8')
+                journal_files.append(flushing_file)
+            pending, self.pending = self.pending, {}
+        if not pending:
+            for journal_file in journal_files:
+                os.remove(journal_file)
+            return 0
+        try:
+            write_punches(entries=pending)
+        except Exception:
+            db.session.rollback()
+            with self.lock:
+                for (user_id, video_id), (play_time, timestamp) in pending.items():
+                    self.merge(user_id=user_id, video_id=video_id, play_time=play_time, timestamp=timestamp)
+            # the journals stay on disk and are claimed again by the next flush
+            raise
+        for journal_file in journal_files:
+            os.remove(journal_file)
+        return len(pending)
+
+
+def write_punches(entries):
+    '''punches.write_punches(entries)'''
+    from app.models import Punch, Video
+    user_ids = {user_id for user_id, video_id in entries}
+    video_ids = {video_id for user_id, video_id in entries}
+    existing = set(db.session.query(Punch.user_id, Punch.video_id)\
+        .filter(Punch.user_id.in_(user_ids))\
+        .filter(Punch.video_id.in_(video_ids))\
+        .all())
+    valid_video_ids = {video_id for video_id, in db.session.query(Video.id).filter(Video.id.in_(video_ids))}
+    updates = []
+    inserts = []
+    for (user_id, video_id), (play_time, timestamp) in entries.items():
+        mapping = {
+            'user_id': user_id,
+            'video_id': video_id,
+            'play_time': timedelta(seconds=play_time),
+            'timestamp': timestamp,
+        }
+        if (user_id, video_id) in existing:
+            updates.append(mapping)
+        elif video_id in valid_video_ids:
+            mapping['synchronized'] = False
+            inserts.append(mapping)
+    if updates:
+        punches = Punch.__table__
+        # other worker processes may have written a later punch already
+        db.session.execute(punches.update()\
+            .where(punches.c.user_id == db.bindparam('b_user_id'))\
+            .where(punches.c.video_id == db.bindparam('b_video_id'))\
+            .where(db.or_(
+                punches.c.timestamp.is_(None),
+                punches.c.timestamp < db.bindparam('b_timestamp')
+            ))\
+            .values(
+                play_time=db.bindparam('b_play_time'),
+                timestamp=db.bindparam('b_timestamp')
+            ), [{
+                'b_user_id': mapping['user_id'],
+                'b_video_id': mapping['video_id'],
+                'b_play_time': mapping['play_time'],
+                'b_timestamp': mapping['timestamp'],
+            } for mapping in updates])
+    if inserts:
+        db.session.bulk_insert_mappings(Punch, inserts)
+    db.session.commit()
+
+
+def punch_buffer():
+    '''punches.punch_buffer()'''
+    return current_app.extensions.get('yvod_punch_buffer')
+
+
+def flush_punches():
+    '''punches.flush_punches()'''
+    buffer = punch_buffer()
+    if buffer is not None:
+        buffer.flush()
+
+
+def init_app(app):
+    '''punches.init_app(app)'''
+    if not app.config['PUNCH_BUFFER_ENABLE']:
+        return
+    app.extensions['yvod_punch_buffer'] = PunchBuffer(
+        journal_dir=os.path.join(app.config['CACHE_DIR'], 'punches'),
+        fsync=app.config['PUNCH_BUFFER_FSYNC']
+    )
+
+    @atexit.register
+    def flush_at_exit():
+        '''punches.flush_at_exit()'''
+        with app.app_context():
+            try:
+                flush_punches()
+            except Exception:
+                app.logger.exception('Failed to flush punches at exit')
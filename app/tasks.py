@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+'''app/tasks.py'''
+
+import os
+import fcntl
+from contextlib import contextmanager
+from threading import Thread, Event
+from datetime import datetime, time, timedelta
+from app.utils import datetime_now, makedirs
+
+
+@contextmanager
+def file_lock(lock_file):
+    '''tasks.file_lock(lock_file)'''
+    if lock_file is None:
+        yield True
+        return
+    makedirs(path=os.path.dirname(lock_file))
+    with open(lock_file, 'a') as f:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def seconds_until_date_boundary(utc_offset=0):
+    '''tasks.seconds_until_date_boundary(utc_offset=0)'''
+    now = datetime_now(utc_offset=utc_offset)
+    boundary = datetime.combine(now.date() + timedelta(days=1), time())
+    return (boundary - now).total_seconds()
+
+
+class PeriodicTask(Thread):
+    '''tasks.PeriodicTask(Thread)'''
+
+    def __init__(self, app, name, target, interval, lock_file=None, run_at_start=False):
+        super().__init__(name=name, daemon=True)
+        self.app = app
+        self.target = target
+        self.interval = interval
+        self.lock_file = lock_file
+        self.run_at_start = run_at_start
+        self.stopped = Event()
+
+    def next_interval(self):
+        '''PeriodicTask.next_interval(self)'''
+        if callable(self.interval):
+            return self.interval()
+        return self.interval
+
+    def run_once(self):
+        '''PeriodicTask.run_once(self)'''
+        with self.app.app_context():
+            try:
+                with file_lock(self.lock_file) as acquired:
+                    if acquired:
+                        self.target()
+            except Exception:
+                self.app.logger.exception('Periodic task failed: {}'.format(self.name))
+
+    def run(self):
+        if self.run_at_start:
+            self.run_once()
+        while not self.stopped.wait(self.next_interval()):
+            self.run_once()
+
+    def stop(self):
+        '''PeriodicTask.stop(self)'''
+        self.stopped.set()
+
+
+def rotate_hls_caches():
+    '''tasks.rotate_hls_caches()'''
+    from app.models import Video
+    Video.refresh_hls_caches()
+
+
+def flush_punches():
+    '''tasks.flush_punches()'''
+    from app.punches import flush_punches as flush_punch_buffer
+    flush_punch_buffer()
+
+
+def flush_presence():
+    '''tasks.flush_presence()'''
+    from app.presence import flush_presence as flush_presence_tracker
+    flush_presence_tracker()
+
+
+def sync_study_progress():
+    '''tasks.sync_study_progress()'''
+    from app.models import SyncTask
+    SyncTask.process()
+
+
+def prewarm_mac_addresses():
+    '''tasks.prewarm_mac_addresses()'''
+    from app.utils import prewarm_mac_address_cache
+    prewarm_mac_address_cache()
+
+
+def export_metrics():
+    '''tasks.export_metrics()'''
+    from flask import current_app
+    from app.metrics import registry, metrics_dir
+    registry.export(metrics_dir=metrics_dir(current_app))
+
+
+def start_tasks(app):
+    '''tasks.start_tasks(app)'''
+    tasks = []
+    if app.config['HLS_ENABLE'] and app.config['HLS_ROTATION_SCHEDULER']:
+        tasks.append(PeriodicTask(
+            app=app,
+            name='hls-rotation',
+            target=rotate_hls_caches,
+            interval=lambda: seconds_until_date_boundary(utc_offset=app.config['UTC_OFFSET']) + 1,
+            lock_file=os.path.join(app.config['CACHE_DIR'], 'hls-rotation.lock'),
+            run_at_start=True
+        ))
+    if 'yvod_punch_buffer' in app.extensions:
+        tasks.append(PeriodicTask(
+            app=app,
+            name='punch-flush',
+            target=flush_punches,
+            interval=app.config['PUNCH_BUFFER_FLUSH_INTERVAL'],
+            run_at_start=True
+        ))
+    if 'yvod_presence_tracker' in app.extensions:
+        tasks.append(PeriodicTask(
+            app=app,
+            name='presence-flush',
+            target=flush_presence,
+            interval=app.config['PRESENCE_FLUSH_INTERVAL']
+        ))
+    if app.config['YSYS_URI'] is not None:
+        tasks.append(PeriodicTask(
+            app=app,
+            name='ysys-sync',
+            target=sync_study_progress,
+            interval=app.config['YSYS_SYNC_INTERVAL'],
+            lock_file=os.path.join(app.config['CACHE_DIR'], 'ysys-sync.lock'),
+            run_at_start=True
+        ))
+    if app.config['MAC_ADDRESS_CACHE_PREWARM'] and os.path.exists('/proc/net/arp'):
+        # every worker process keeps its own cache
+        tasks.append(PeriodicTask(
+            app=app,
+            name='mac-prewarm',
+            target=prewarm_mac_addresses,
+            interval=app.config['MAC_ADDRESS_CACHE_PREWARM_INTERVAL'],
+            run_at_start=True
+        ))
+    if app.config['METRICS_TOKEN'] is not None:
+        # every worker process exports its own metrics
+        tasks.append(PeriodicTask(
+            app=app,
+            name='metrics-export',
+            target=export_metrics,
+            interval=app.config['METRICS_EXPORT_INTERVAL']
+        ))
+    for task in tasks:
+        task.start()
+    return tasks
+
+
+def init_app(app):
+    '''tasks.init_app(app)'''
+    @app.before_first_request
+    def start_background_tasks():
+        '''tasks.start_background_tasks()'''
+        app.extensions['yvod_tasks'] = start_tasks(app)
@@ -6,20 +6,37 @@ import os
 import io
 import re
 import operator
+import fcntl
 from functools import reduce
-from shutil import rmtree
-from datetime import datetime, timedelta
+from shutil import rmtree, copyfile
+from datetime import datetime, timedelta, timezone
+from secrets import token_hex
+from threading import Lock
+from time import perf_counter, monotonic
+from collections import OrderedDict
 from json import JSONDecodeError
 import csv
 import yaml
 from getmac import get_mac_address
 from pymediainfo import MediaInfo
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException
-from itsdangerous import TimedJSONWebSignatureSerializer
+from urllib3.util.retry import Retry
+from itsdangerous import TimedJSONWebSignatureSerializer, URLSafeTimedSerializer, BadData
+from werkzeug.http import http_date, parse_date
+from werkzeug.urls import url_quote
+from werkzeug.wsgi import ClosingIterator
 from flask import Response
-from flask import current_app
+from flask import current_app, g, has_app_context
 from pypinyin import slug, Style
+import htmlmin
+from jinja2.ext import Extension
+from app.metrics import video_requests, video_bytes, video_streams
+from app.metrics import ysys_requests, ysys_duration
+
+
+FICLONE = 0x40049409 # Linux ioctl: share the extents of another file (copy-on-write)
 
 
 def makedirs(path, overwrite=False):
@@ -30,6 +47,42 @@ def makedirs(path, overwrite=False):
         os.makedirs(path)
 
 
+def reflink(source, destination):
+    '''utils.reflink(source, destination)'''
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def materialize_file(source, destination, strategies=('reflink', 'hardlink', 'symlink', 'copy')):
+    '''utils.materialize_file(source, destination, strategies=('reflink', 'hardlink', 'symlink', 'copy'))'''
+    if not os.path.isfile(source):
+        raise FileNotFoundError(source)
+    error = None
+    # only the temporary file created here is cleaned up: an existing destination is replaced at the end
+    temporary_destination = '{}.{}.tmp'.format(destination, token_hex(4))
+    for strategy in strategies:
+        try:
+            if strategy == 'reflink':
+                reflink(source, temporary_destination)
+            elif strategy == 'hardlink':
+                os.link(source, temporary_destination)
+            elif strategy == 'symlink':
+                os.symlink(os.path.abspath(source), temporary_destination)
+            elif strategy == 'copy':
+                copyfile(source, temporary_destination)
+            else:
+                continue
+            os.replace(temporary_destination, destination)
+            return strategy
+        except OSError as e:
+            error = e
+            if os.path.lexists(temporary_destination):
+                os.remove(temporary_destination)
+    if error is not None:
+        raise error
+    raise ValueError('No valid cache materialization strategy: {}'.format(strategies))
+
+
 def datetime_now(utc_offset=0):
     '''utils.datetime_now(utc_offset=0)'''
     return datetime.utcnow() + timedelta(hours=utc_offset)
@@ -86,19 +139,82 @@ def load_yaml(yaml_file):
     return None
 
 
+def read_version(version_file):
+    '''utils.read_version(version_file)'''
+    try:
+        with io.open(version_file, 'rt') as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def bump_version(version_file):
+    '''utils.bump_version(version_file)'''
+    makedirs(path=os.path.dirname(version_file))
+    version = token_hex(8)
+    temporary_version_file = '{}.{}.tmp'.format(version_file, version)
+    with io.open(temporary_version_file, 'wt') as f:
+        f.write(version)
+    os.replace(temporary_version_file, version_file)
+    return version
+
+
+def mac_address_cache():
+    '''utils.mac_address_cache()'''
+    cache = current_app.extensions.get('yvod_mac_address_cache')
+    if cache is None:
+        cache = TTLCache(max_size=current_app.config['MAC_ADDRESS_CACHE_SIZE'])
+        current_app.extensions['yvod_mac_address_cache'] = cache
+    return cache
+
+
 def get_mac_address_from_ip(ip_address):
     '''utils.get_mac_address_from_ip(ip_address)'''
     if ip_address is None:
         return None
+    cache = mac_address_cache()
+    mac_address = cache.get(ip_address)
+    if mac_address is not None:
+        return mac_address
     if ip_address == '127.0.0.1':
         mac_address = get_mac_address()
     else:
         mac_address = get_mac_address(ip=ip_address)
     if mac_address is not None:
-        return mac_address.upper()
+        mac_address = mac_address.upper()
+        cache.set(ip_address, mac_address, ttl=current_app.config['MAC_ADDRESS_CACHE_TTL'])
+        return mac_address
     return None
 
 
+def read_arp_table(arp_file='/proc/net/arp'):
+    '''utils.read_arp_table(arp_file='/proc/net/arp')'''
+    entries = {}
+    if not os.path.exists(arp_file):
+        return entries
+    with io.open(arp_file, 'rt') as f:
+        next(f, None)
+        for line in f:
+            fields = line.split()
+            if len(fields) < 4:
+                continue
+            ip_address, flags, mac_address = fields[0], fields[2], fields[3]
+            # skip incomplete entries
+            if int(flags, 16) & 0x2 == 0 or mac_address == '00:00:00:00:00:00':
+                continue
+            entries[ip_address] = mac_address.upper()
+    return entries
+
+
+def prewarm_mac_address_cache():
+    '''utils.prewarm_mac_address_cache()'''
+    cache = mac_address_cache()
+    entries = read_arp_table()
+    for ip_address, mac_address in entries.items():
+        cache.set(ip_address, mac_address, ttl=current_app.config['MAC_ADDRESS_CACHE_TTL'])
+    return len(entries)
+
+
 def get_video_duration(video_file):
     '''utils.get_video_duration(video_file)'''
     if os.path.exists(video_file):
@@ -107,30 +223,240 @@ def get_video_duration(video_file):
     return None
 
 
+def parse_byte_ranges(range_header, file_size, max_ranges=None):
+    '''utils.parse_byte_ranges(range_header, file_size, max_ranges=None)'''
+    m = re.match(r'^\s*bytes\s*=\s*(?P<ranges>.+)$', range_header or '')
+    if not m:
+        return None
+    byte_ranges = []
+    for byte_range in m.group('ranges').split(','):
+        n = re.match(r'^\s*(?P<start>\d*)\s*-\s*(?P<end>\d*)\s*$', byte_range)
+        if not n or (n.group('start') == '' and n.group('end') == ''):
+            return None
+        if n.group('start') == '':
+            # suffix range: the last N bytes of the file
+            suffix_length = int(n.group('end'))
+            if suffix_length == 0:
+                continue
+            start = max(file_size - suffix_length, 0)
+            end = file_size - 1
+        else:
+            start = int(n.group('start'))
+            if n.group('end') == '':
+                end = file_size - 1
+            else:
+                if int(n.group('end')) < start:
+                    return None
+                end = min(int(n.group('end')), file_size - 1)
+        if start >= file_size or end < start:
+            continue
+        byte_ranges.append((start, end))
+    # overlapping and adjacent ranges are coalesced (RFC 7233, section 6.1)
+    merged_byte_ranges = []
+    for start, end in sorted(byte_ranges):
+        if merged_byte_ranges and start <= merged_byte_ranges[-1][1] + 1:
+            merged_byte_ranges[-1] = (merged_byte_ranges[-1][0], max(merged_byte_ranges[-1][1], end))
+        else:
+            merged_byte_ranges.append((start, end))
+    if max_ranges is not None and len(merged_byte_ranges) > max_ranges:
+        # too many ranges: the whole file is served instead
+        return None
+    return merged_byte_ranges
+
+
+def video_file_etag(file_stat):
+    '''utils.video_file_etag(file_stat)'''
+    return '{:x}-{:x}'.format(int(file_stat.st_mtime), file_stat.st_size)
+
+
+def if_range_matches(if_range, etag, last_modified):
+    '''utils.if_range_matches(if_range, etag, last_modified)'''
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('W/'):
+        # weak validators must not be used with If-Range
+        return False
+    if if_range.startswith('"'):
+        return if_range.strip('"') == etag
+    if_range_date = parse_date(if_range)
+    return if_range_date is not None and \
+        int(if_range_date.replace(tzinfo=timezone.utc).timestamp()) == int(last_modified)
+
+
+def iter_file_range(video_file, start, end, chunk_size):
+    '''utils.iter_file_range(video_file, start, end, chunk_size)'''
+    with open(video_file, 'rb') as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+class ClosingFile:
+    '''utils.ClosingFile'''
+
+    def __init__(self, f, on_close):
+        self.f = f
+        self.on_close = on_close
+
+    def fileno(self):
+        '''ClosingFile.fileno(self)'''
+        return self.f.fileno()
+
+    def read(self, size=-1):
+        '''ClosingFile.read(self, size=-1)'''
+        return self.f.read(size)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        '''ClosingFile.seek(self, offset, whence=os.SEEK_SET)'''
+        return self.f.seek(offset, whence)
+
+    def tell(self):
+        '''ClosingFile.tell(self)'''
+        return self.f.tell()
+
+    def close(self):
+        '''ClosingFile.close(self)'''
+        try:
+            self.f.close()
+        finally:
+            on_close, self.on_close = self.on_close, None
+            if on_close is not None:
+                on_close()
+
+
+def wrap_file_range(video_file, start, end, file_size, chunk_size, request, on_close=None):
+    '''utils.wrap_file_range(video_file, start, end, file_size, chunk_size, request, on_close=None)'''
+    # direct passthrough responses are never wrapped by Werkzeug: the iterable itself calls on_close
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if file_wrapper is not None and current_app.config['VIDEO_SENDFILE'] and end == file_size - 1 and \
+        (start == 0 or current_app.config['VIDEO_SENDFILE_RANGES']):
+        # hand the file descriptor to the WSGI server, which may serve it with os.sendfile
+        f = open(video_file, 'rb')
+        f.seek(start)
+        if on_close is not None:
+            f = ClosingFile(f=f, on_close=on_close)
+        return file_wrapper(f, chunk_size)
+    if on_close is None:
+        return iter_file_range(video_file, start, end, chunk_size)
+    return ClosingIterator(iter_file_range(video_file, start, end, chunk_size), on_close)
+
+
+def iter_file_multipart(video_file, byte_ranges, file_size, boundary, mimetype, chunk_size):
+    '''utils.iter_file_multipart(video_file, byte_ranges, file_size, boundary, mimetype, chunk_size)'''
+    for start, end in byte_ranges:
+        yield multipart_header(boundary, mimetype, start, end, file_size)
+        for chunk in iter_file_range(video_file, start, end, chunk_size):
+            yield chunk
+    yield '\r\n--{}--\r\n'.format(boundary).encode('ascii')
+
+
+def multipart_header(boundary, mimetype, start, end, file_size):
+    '''utils.multipart_header(boundary, mimetype, start, end, file_size)'''
+    return '\r\n--{}\r\nContent-Type: {}\r\nContent-Range: bytes {}-{}/{}\r\n\r\n'.format(
+        boundary,
+        mimetype,
+        start,
+        end,
+        file_size
+    ).encode('ascii')
+
+
+def offload_video_file(video_file, mimetype='video/mp4'):
+    '''utils.offload_video_file(video_file, mimetype='video/mp4')'''
+    offload = current_app.config['VIDEO_OFFLOAD']
+    video_path = os.path.relpath(video_file, current_app.config['VIDEO_DIR'])
+    if video_path.startswith(os.pardir):
+        return None
+    resp = Response(mimetype=mimetype)
+    if offload == 'X-Accel-Redirect':
+        resp.headers['X-Accel-Redirect'] = '{}/{}'.format(
+            current_app.config['VIDEO_OFFLOAD_LOCATION'].rstrip('/'),
+            url_quote(video_path.replace(os.sep, '/'))
+        )
+    elif offload == 'X-Sendfile':
+        resp.headers['X-Sendfile'] = os.path.abspath(video_file)
+    else:
+        return None
+    return resp
+
+
 def send_video_file(video_file, request, mimetype='video/mp4'):
     '''utils.send_video_file(video_file, request, mimetype='video/mp4')'''
-    file_size = os.path.getsize(video_file)
-    m = re.match(r'bytes=(?P<start>\d+)-(?P<end>\d+)?', request.headers.get('Range'))
-    if m:
-        start = m.group('start')
-        end = m.group('end')
-        start = int(start)
-        end = (file_size - 1) if end is None else min(int(end), file_size - 1)
+    if current_app.config['VIDEO_OFFLOAD'] is not None:
+        resp = offload_video_file(video_file=video_file, mimetype=mimetype)
+        if resp is not None:
+            video_requests.inc(status='offload')
+            return resp
+    file_stat = os.stat(video_file)
+    file_size = file_stat.st_size
+    etag = video_file_etag(file_stat)
+    chunk_size = current_app.config['VIDEO_CHUNK_SIZE']
+    byte_ranges = None
+    if 'Range' in request.headers and \
+        if_range_matches(request.headers.get('If-Range'), etag, file_stat.st_mtime):
+        byte_ranges = parse_byte_ranges(
+            request.headers.get('Range'),
+            file_size,
+            max_ranges=current_app.config['VIDEO_MAX_RANGES']
+        )
+    on_close = video_streams.dec
+    if byte_ranges is None:
+        resp = Response(
+            response=wrap_file_range(video_file, 0, file_size - 1, file_size, chunk_size, request, on_close),
+            status=200,
+            mimetype=mimetype,
+            direct_passthrough=True
+        )
+        resp.headers['Content-Length'] = str(file_size)
+    elif len(byte_ranges) == 0:
+        resp = Response(response=b'', status=416, mimetype=mimetype)
+        resp.headers['Content-Range'] = 'bytes */{}'.format(file_size)
+        resp.headers['Content-Length'] = '0'
+    elif len(byte_ranges) == 1:
+        start, end = byte_ranges[0]
+        resp = Response(
+            response=wrap_file_range(video_file, start, end, file_size, chunk_size, request, on_close),
+            status=206,
+            mimetype=mimetype,
+            direct_passthrough=True
+        )
+        resp.headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, file_size)
+        resp.headers['Content-Length'] = str(end - start + 1)
     else:
-        start = 0
-        end = file_size - 1
-    length = end - start + 1
-    with open(video_file, 'rb') as f:
-        f.seek(start)
-        video_file_chunk = f.read(length)
-    resp = Response(
-        response=video_file_chunk,
-        status=206,
-        mimetype=mimetype,
-        direct_passthrough=True
-    )
-    resp.headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, file_size)
+        boundary = token_hex(16)
+        content_length = len('\r\n--{}--\r\n'.format(boundary))
+        for start, end in byte_ranges:
+            content_length += len(multipart_header(boundary, mimetype, start, end, file_size))
+            content_length += end - start + 1
+        resp = Response(
+            response=ClosingIterator(iter_file_multipart(
+                video_file,
+                byte_ranges,
+                file_size,
+                boundary,
+                mimetype,
+                chunk_size
+            ), on_close),
+            status=206,
+            content_type='multipart/byteranges; boundary={}'.format(boundary),
+            direct_passthrough=True
+        )
+        resp.headers['Content-Length'] = str(content_length)
     resp.headers['Accept-Ranges'] = 'bytes'
+    resp.headers['ETag'] = '"{}"'.format(etag)
+    resp.headers['Last-Modified'] = http_date(file_stat.st_mtime)
+    video_requests.inc(status=resp.status_code)
+    if resp.status_code != 416:
+        # released by the response iterable when the WSGI server closes it
+        video_streams.inc()
+        if request.method != 'HEAD':
+            video_bytes.inc(int(resp.headers['Content-Length']))
     return resp
 
 
@@ -141,24 +467,356 @@ def format_duration(duration):
     return '{:02.0f}:{:02.0f}:{:02.0f}'.format(hours, minutes, duration.total_seconds())
 
 
+class CircuitBreaker:
+    '''utils.CircuitBreaker'''
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.trip_count = 0
+        self.rejected_count = 0
+
+    def allow_request(self):
+        '''CircuitBreaker.allow_request(self)'''
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self.probing = False
+            # a half-open breaker lets a single probe request through
+            if self.state == self.HALF_OPEN and not self.probing:
+                self.probing = True
+                return True
+            self.rejected_count += 1
+            return False
+
+    def record_success(self):
+        '''CircuitBreaker.record_success(self)'''
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.probing = False
+
+    def record_failure(self):
+        '''CircuitBreaker.record_failure(self)'''
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.trip_count += 1
+                self.state = self.OPEN
+                self.opened_at = monotonic()
+                self.probing = False
+
+    @property
+    def rejecting(self):
+        '''CircuitBreaker.rejecting(self)'''
+        with self.lock:
+            if self.state == self.OPEN:
+                return monotonic() - self.opened_at < self.reset_timeout
+            return self.state == self.HALF_OPEN and self.probing
+
+    def status(self):
+        '''CircuitBreaker.status(self)'''
+        with self.lock:
+            retry_in = None
+            if self.state == self.OPEN:
+                retry_in = max(0.0, self.reset_timeout - (monotonic() - self.opened_at))
+            return {
+                'state': self.state,
+                'failures': self.failures,
+                'failure_threshold': self.failure_threshold,
+                'reset_timeout': self.reset_timeout,
+                'retry_in': retry_in,
+                'trip_count': self.trip_count,
+                'rejected_count': self.rejected_count,
+            }
+
+
+class YSystemClient:
+    '''utils.YSystemClient'''
+
+    def __init__(self, base_uri, secret_key, token_expiration, timeout, connect_timeout=3, pool_size=10, retries=2,
+        retry_backoff=0.3, breaker_failure_threshold=5, breaker_reset_timeout=30):
+        self.base_uri = base_uri
+        # a retried connection attempt waits for connect_timeout, not for the whole read timeout
+        self.timeout = (connect_timeout, timeout)
+        self.pid = os.getpid()
+        self.serial = TimedJSONWebSignatureSerializer(secret_key=secret_key, expires_in=token_expiration)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=Retry(
+                total=retries,
+                read=0,
+                backoff_factor=retry_backoff,
+                method_whitelist=frozenset(['GET']),
+                status_forcelist=(502, 503, 504),
+                raise_on_status=False
+            )
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.breaker = CircuitBreaker(
+            failure_threshold=breaker_failure_threshold,
+            reset_timeout=breaker_reset_timeout
+        )
+        self.lock = Lock()
+        self.stats = {}
+
+    def new_stat(self, api):
+        '''YSystemClient.new_stat(self, api)'''
+        return self.stats.setdefault(api, {
+            'count': 0,
+            'errors': 0,
+            'rejected': 0,
+            'total_time': 0.0,
+            'max_time': 0.0,
+            'last_time': 0.0,
+        })
+
+    def record_rejected(self, api):
+        '''YSystemClient.record_rejected(self, api)'''
+        with self.lock:
+            self.new_stat(api=api)['rejected'] += 1
+
+    def record(self, api, elapsed, error=False):
+        '''YSystemClient.record(self, api, elapsed, error=False)'''
+        with self.lock:
+            stat = self.new_stat(api=api)
+            stat['count'] += 1
+            stat['errors'] += int(error)
+            stat['total_time'] += elapsed
+            stat['max_time'] = max(stat['max_time'], elapsed)
+            stat['last_time'] = elapsed
+
+    def latency_stats(self):
+        '''YSystemClient.latency_stats(self)'''
+        with self.lock:
+            return {api: dict(stat, average_time=stat['total_time'] / stat['count'] if stat['count'] else 0.0) \
+                for api, stat in self.stats.items()}
+
+    def request(self, api, token_data):
+        '''YSystemClient.request(self, api, token_data)'''
+        # fail fast instead of waiting for timeouts while Y-System is down
+        if not self.breaker.allow_request():
+            self.record_rejected(api=api)
+            ysys_requests.inc(api=api, outcome='rejected')
+            return None
+        start = perf_counter()
+        data = None
+        try:
+            api_request = self.session.get('{}/api/{}/{}'.format(
+                self.base_uri,
+                api,
+                self.serial.dumps(token_data).decode('ascii')
+            ), timeout=self.timeout)
+            data = api_request.json()
+        except (RequestException, JSONDecodeError):
+            pass
+        finally:
+            if data is None:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            elapsed = perf_counter() - start
+            self.record(api=api, elapsed=elapsed, error=data is None)
+            ysys_requests.inc(api=api, outcome='failure' if data is None else 'success')
+            ysys_duration.observe(elapsed, api=api)
+        return data
+
+
+def y_system_client():
+    '''utils.y_system_client()'''
+    client = current_app.extensions.get('yvod_ysys_client')
+    # connection pools must not be shared with a forked worker
+    if client is None or client.pid != os.getpid():
+        client = YSystemClient(
+            base_uri=current_app.config['YSYS_URI'],
+            secret_key=current_app.config['AUTH_TOKEN_SECRET_KEY'],
+            token_expiration=current_app.config['TOKEN_EXPIRATION'],
+            timeout=current_app.config['REQUEST_TIMEOUT'],
+            connect_timeout=current_app.config['YSYS_CONNECT_TIMEOUT'],
+            pool_size=current_app.config['YSYS_POOL_SIZE'],
+            retries=current_app.config['YSYS_RETRIES'],
+            retry_backoff=current_app.config['YSYS_RETRY_BACKOFF'],
+            breaker_failure_threshold=current_app.config['YSYS_BREAKER_FAILURE_THRESHOLD'],
+            breaker_reset_timeout=current_app.config['YSYS_BREAKER_RESET_TIMEOUT']
+        )
+        current_app.extensions['yvod_ysys_client'] = client
+    return client
+
+
+class TTLCache:
+    '''utils.TTLCache'''
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.lock = Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key, max_stale=0):
+        '''TTLCache.get(self, key, max_stale=0)'''
+        # expired entries are kept until evicted, so that they can be served stale
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or monotonic() >= entry[1] + max_stale:
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, ttl):
+        '''TTLCache.set(self, key, value, ttl)'''
+        with self.lock:
+            self.entries[key] = (value, monotonic() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, predicate=None):
+        '''TTLCache.invalidate(self, predicate=None)'''
+        with self.lock:
+            if predicate is None:
+                self.entries.clear()
+                return
+            for key in [key for key in self.entries if predicate(key)]:
+                del self.entries[key]
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def add_request_timing(name, elapsed):
+    '''utils.add_request_timing(name, elapsed)'''
+    if has_app_context():
+        timings = g.setdefault('request_timings', {})
+        timings[name] = timings.get(name, 0.0) + elapsed
+
+
+def minify(html):
+    '''utils.minify(html)'''
+    # templates are minified once when they are loaded (MinifyExtension)
+    if current_app.config['MINIFY_TEMPLATES']:
+        return html
+    start = perf_counter()
+    minified = htmlmin.minify(html)
+    add_request_timing(name='minify', elapsed=perf_counter() - start)
+    return minified
+
+
+PRESERVED_PATTERN = re.compile(r'<(pre|textarea|script|style)\b.*?</\1\s*>', re.DOTALL | re.IGNORECASE)
+
+SPACE_PATTERN = re.compile(r'\s+')
+
+
+def collapse_space(match):
+    '''utils.collapse_space(match)'''
+    # a line break is kept, so that inline scripts rendered by macros keep their meaning
+    if '\n' in match.group(0):
+        return '\n'
+    return ' '
+
+
+def minify_template(source):
+    '''utils.minify_template(source)'''
+    # like htmlmin: whitespace is collapsed, except inside preformatted text, scripts and styles
+    chunks = []
+    position = 0
+    for match in PRESERVED_PATTERN.finditer(source):
+        chunks.append(SPACE_PATTERN.sub(collapse_space, source[position:match.start()]))
+        chunks.append(match.group(0))
+        position = match.end()
+    chunks.append(SPACE_PATTERN.sub(collapse_space, source[position:]))
+    return ''.join(chunks)
+
+
+class MinifyExtension(Extension):
+    '''utils.MinifyExtension(Extension)'''
+
+    def preprocess(self, source, name, filename=None):
+        '''MinifyExtension.preprocess(self, source, name, filename=None)'''
+        if name is None or not name.endswith('.html'):
+            return source
+        return minify_template(source)
+
+
 def y_system_api_request(api, token_data):
     '''utils.y_system_api_request(api, token_data)'''
-    serial = TimedJSONWebSignatureSerializer(
-        secret_key=current_app.config['AUTH_TOKEN_SECRET_KEY'],
-        expires_in=current_app.config['TOKEN_EXPIRATION']
-    )
-    try:
-        api_request = requests.get('{}/api/{}/{}'.format(
-            current_app.config['YSYS_URI'],
-            api,
-            serial.dumps(token_data).decode('ascii')
-        ), timeout=current_app.config['REQUEST_TIMEOUT'])
-        data = api_request.json()
-    except (RequestException, JSONDecodeError):
-        data = None
+    return y_system_client().request(api=api, token_data=token_data)
+
+
+def lesson_access_cache():
+    '''utils.lesson_access_cache()'''
+    cache = current_app.extensions.get('yvod_lesson_access_cache')
+    if cache is None:
+        cache = TTLCache(max_size=current_app.config['LESSON_ACCESS_CACHE_SIZE'])
+        current_app.extensions['yvod_lesson_access_cache'] = cache
+    return cache
+
+
+def request_lesson_access(user_id, lesson):
+    '''utils.request_lesson_access(user_id, lesson)'''
+    cache = lesson_access_cache()
+    key = (user_id, lesson)
+    data = cache.get(key)
+    if data is not None:
+        return data
+    data = y_system_api_request(api='lesson-access', token_data={
+        'user_id': user_id,
+        'lesson': lesson,
+    })
+    if data is None:
+        # Y-System is unreachable: fall back to a recently expired decision
+        return cache.get(key, max_stale=current_app.config['LESSON_ACCESS_CACHE_STALE_TTL'])
+    if verify_data_keys(data=data, keys=['error']):
+        cache.set(key, data, ttl=current_app.config['LESSON_ACCESS_CACHE_NEGATIVE_TTL'])
+    else:
+        cache.set(key, data, ttl=current_app.config['LESSON_ACCESS_CACHE_TTL'])
     return data
 
 
+def invalidate_lesson_access(user_id):
+    '''utils.invalidate_lesson_access(user_id)'''
+    lesson_access_cache().invalidate(predicate=lambda key: key[0] == user_id)
+
+
+def playback_token_serializer():
+    '''utils.playback_token_serializer()'''
+    return URLSafeTimedSerializer(secret_key=current_app.config['SECRET_KEY'], salt='playback-token')
+
+
+def generate_playback_token(user_id, video_id):
+    '''utils.generate_playback_token(user_id, video_id)'''
+    return playback_token_serializer().dumps({
+        'user_id': user_id,
+        'video_id': video_id,
+    })
+
+
+def verify_playback_token(token, user_id, video_id):
+    '''utils.verify_playback_token(token, user_id, video_id)'''
+    if not token:
+        return False
+    try:
+        data = playback_token_serializer().loads(token, max_age=current_app.config['PLAYBACK_TOKEN_EXPIRATION'])
+    except BadData:
+        return False
+    return isinstance(data, dict) and \
+        data.get('user_id') == user_id and \
+        data.get('video_id') == video_id
+
+
 def verify_data_keys(data, keys):
     '''utils.verify_data_keys(data, keys)'''
     return data is not None and \
@@ -2,7 +2,6 @@
 
 '''app/views/auth.py'''
 
-from htmlmin import minify
 from flask import Blueprint
 from flask import render_template, redirect, request, url_for, flash
 from flask import current_app
@@ -12,7 +11,11 @@ from app.models import Role, User
 from app.models import Device
 from app.utils import get_mac_address_from_ip
 from app.utils import y_system_api_request, verify_data_keys
+from app.utils import invalidate_lesson_access
+from app.utils import minify
 from app.utils2 import get_device_info, add_user_log
+from app.presence import record_presence
+from app.metrics import auth_duration
 from app.forms.auth import LoginForm
 
 
@@ -20,10 +23,11 @@ auth = Blueprint('auth', __name__)
 
 
 @auth.before_app_request
+@auth_duration.time()
 def before_request():
     '''auth.before_request()'''
     if current_user.is_authenticated:
-        current_user.ping()
+        record_presence(user=current_user._get_current_object())
         mac_address = get_mac_address_from_ip(ip_address=request.headers\
             .get('X-Forwarded-For', request.remote_addr))
         if mac_address is not None and mac_address != current_user.last_seen_mac:
@@ -36,7 +40,9 @@ def before_request():
                 )),
                 category='access'
             )
-        db.session.commit()
+        # without a presence tracker, record_presence() pings the user in the session
+        if db.session.dirty or db.session.new:
+            db.session.commit()
 
 
 @auth.route('/login', methods=['GET', 'POST'])
@@ -115,6 +121,7 @@ def login():
         if data.get('y_gre_aw_progress') is not None:
             user.sync_punch(section=data.get('y_gre_aw_progress'))
         login_user(user, remember=current_app.config['AUTH_REMEMBER_LOGIN'])
+        invalidate_lesson_access(user_id=user.id)
         add_user_log(user=user, event='登录系统', category='auth')
         db.session.commit()
         return redirect(request.args.get('next') or user.index_url)
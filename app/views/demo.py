@@ -2,12 +2,15 @@
 
 '''app/views/demo.py'''
 
-from htmlmin import minify
 from flask import Blueprint, render_template, redirect, request, url_for, flash
+from flask import current_app
 from flask_login import current_user
-from app.models import Device
-from app.models import LessonType, Lesson, Video
+from app.models import device_index
+from app.models import Video
 from app.utils import get_mac_address_from_ip
+from app.utils import minify
+from app.catalog import render_catalog
+from app.metrics import hls_urls
 
 
 demo = Blueprint('demo', __name__)
@@ -23,7 +26,7 @@ def lesson():
     if mac_address is None:
         flash('无法获取设备信息', category='error')
         return redirect(url_for('auth.login'))
-    device = Device.query.filter_by(mac_address=mac_address).first()
+    device = device_index.device(mac_address=mac_address)
     if device is None:
         flash('设备未授权（MAC地址：{}）'.format(mac_address), category='error')
         return redirect(url_for('auth.login'))
@@ -31,15 +34,11 @@ def lesson():
     if not device.can_access_lesson_type(lesson_type=lesson_type):
         flash('该设备无法访问“{}”资源'.format(lesson_type), category='error')
         return redirect(url_for('auth.login'))
-    lessons = Lesson.query\
-        .join(LessonType, LessonType.id == Lesson.type_id)\
-        .filter(LessonType.name == lesson_type)\
-        .order_by(Lesson.id.asc())
-    return minify(render_template(
-        'demo/lesson.html',
-        header=lesson_type,
-        lessons=lessons
-    ))
+    return render_catalog(
+        template='demo/lesson.html',
+        fragment_template='demo/_catalog.html',
+        lesson_type=lesson_type
+    )
 
 
 @demo.route('/video/<int:id>')
@@ -52,7 +51,7 @@ def video(id):
     if mac_address is None:
         flash('无法获取设备信息', category='error')
         return redirect(url_for('auth.login'))
-    device = Device.query.filter_by(mac_address=mac_address).first()
+    device = device_index.device(mac_address=mac_address)
     if device is None:
         flash('设备未授权（MAC地址：{}）'.format(mac_address), category='error')
         return redirect(url_for('auth.login'))
@@ -60,6 +59,8 @@ def video(id):
     if not device.can_access_lesson_type(lesson_type=video.lesson.type):
         flash('该设备无法访问“{}”资源'.format(video.lesson.type.name), category='error')
         return redirect(url_for('auth.login'))
+    if current_app.config['HLS_ENABLE']:
+        hls_urls.inc(lesson_type=video.lesson.type.name)
     return minify(render_template(
         'demo/video.html',
         video=video
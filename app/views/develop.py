@@ -2,7 +2,6 @@
 
 '''app/views/develop.py'''
 
-from htmlmin import minify
 from flask import Blueprint
 from flask import render_template, redirect, request, make_response, url_for
 from flask import current_app
@@ -11,6 +10,9 @@ from app.models import Role
 from app.models import Permission
 from app.models import UserLog
 from app.decorators import role_required
+from app.utils import y_system_client
+from app.profiling import request_profiler, query_budget
+from app.utils import minify
 
 
 develop = Blueprint('develop', __name__)
@@ -188,4 +190,22 @@ def access_logs():
 @role_required('开发人员')
 def configuration():
     '''develop.configuration()'''
-    return minify(render_template('develop/configuration.html'))
+    return minify(render_template(
+        'develop/configuration.html',
+        ysys_stats=y_system_client().latency_stats(),
+        ysys_breaker=y_system_client().breaker.status()
+    ))
+
+
+@develop.route('/profiling')
+@login_required
+@role_required('开发人员')
+def profiling():
+    '''develop.profiling()'''
+    profiler = request_profiler()
+    summary = {} if profiler is None else profiler.summary()
+    return minify(render_template(
+        'develop/profiling.html',
+        summary=summary,
+        budgets={endpoint: query_budget(endpoint=endpoint) for endpoint in summary}
+    ))
@@ -2,13 +2,15 @@
 
 '''app/views/main.py'''
 
-from htmlmin import minify
+from hmac import compare_digest
 from flask import Blueprint
 from flask import render_template, jsonify, redirect, request, url_for, abort
-from flask import current_app
+from flask import current_app, Response
 from flask_login import current_user
 from flask_sqlalchemy import get_debug_queries
 from flask_wtf.csrf import CSRFError
+from app.utils import minify
+from app.metrics import collect as collect_metrics, render as render_metrics, metrics_dir
 
 
 main = Blueprint('main', __name__)
@@ -69,6 +71,22 @@ def after_request(response):
     return response
 
 
+@main.route('/metrics')
+def metrics():
+    '''main.metrics()'''
+    token = current_app.config['METRICS_TOKEN']
+    if token is None:
+        abort(404)
+    authorization = request.headers.get('Authorization', '')
+    if not compare_digest(authorization.encode('utf-8'), 'Bearer {}'.format(token).encode('utf-8')) and \
+        not compare_digest(request.args.get('token', '').encode('utf-8'), token.encode('utf-8')):
+        abort(403)
+    return Response(
+        render_metrics(totals=collect_metrics(metrics_dir=metrics_dir(current_app))),
+        mimetype='text/plain; version=0.0.4'
+    )
+
+
 @main.route('/shutdown')
 def server_shutdown():
     '''main.server_shutdown()'''
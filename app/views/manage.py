@@ -2,7 +2,6 @@
 
 '''app/views/manage.py'''
 
-from htmlmin import minify
 from flask import Blueprint
 from flask import render_template, redirect, request, make_response, url_for, abort, flash
 from flask import current_app
@@ -12,6 +11,7 @@ from app.models import Role, User
 from app.models import DeviceType, Device
 from app.models import LessonType, Lesson, Video
 from app.decorators import permission_required, role_required
+from app.utils import minify
 from app.utils2 import add_user_log
 from app.forms.manage import DeviceForm
 
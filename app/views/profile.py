@@ -2,14 +2,15 @@
 
 '''app/views/profile.py'''
 
-from htmlmin import minify
 from flask import Blueprint
 from flask import render_template, request, abort
 from flask import current_app
 from flask_login import login_required, current_user
+from app import db
 from app.models import User
 from app.models import UserLog
 from app.models import LessonType, Lesson
+from app.utils import minify
 
 
 profile = Blueprint('profile', __name__)
@@ -26,12 +27,16 @@ def overview(id):
     lessons = Lesson.query\
         .join(LessonType, LessonType.id == Lesson.type_id)\
         .filter(LessonType.login_required == True)\
-        .order_by(Lesson.id.asc())
+        .options(db.contains_eager(Lesson.type))\
+        .order_by(Lesson.id.asc())\
+        .all()
+    lesson_progress = user.lesson_progress_entries(lesson_ids=[lesson.id for lesson in lessons])
     return minify(render_template(
         'profile/overview.html',
         profile_tab=tab,
         user=user,
-        lessons=lessons
+        lessons=lessons,
+        lesson_progress=lesson_progress
     ))
 
 
@@ -4,10 +4,10 @@
 
 import os
 from flask import Blueprint
-from flask import send_file, redirect, request, url_for, abort
+from flask import redirect, request, url_for, abort
 from flask import current_app
 from flask_login import login_required, current_user
-from app.models import Device
+from app.models import device_index
 from app.models import Video
 from app.decorators import permission_required
 from app.utils import get_mac_address_from_ip, send_video_file
@@ -29,9 +29,7 @@ def video(id):
     video_file = os.path.join(current_app.config['VIDEO_DIR'], video.file_name)
     if not os.path.exists(video_file):
         abort(404)
-    if 'Range' in request.headers:
-        return send_video_file(video_file=video_file, request=request)
-    return send_file(video_file, mimetype='video/mp4')
+    return send_video_file(video_file=video_file, request=request)
 
 
 @resource.route('/demo/video/<int:id>')
@@ -41,7 +39,7 @@ def demo_video(id):
         .get('X-Forwarded-For', request.remote_addr))
     if mac_address is None:
         abort(403)
-    device = Device.query.filter_by(mac_address=mac_address).first()
+    device = device_index.device(mac_address=mac_address)
     if device is None:
         abort(403)
     if current_app.config['HLS_ENABLE']:
@@ -52,9 +50,7 @@ def demo_video(id):
     video_file = os.path.join(current_app.config['VIDEO_DIR'], video.file_name)
     if not os.path.exists(video_file):
         abort(404)
-    if 'Range' in request.headers:
-        return send_video_file(video_file=video_file, request=request)
-    return send_file(video_file, mimetype='video/mp4')
+    return send_video_file(video_file=video_file, request=request)
 
 
 @resource.route('/video/forbidden')
@@ -65,6 +61,4 @@ def video_forbidden():
     video_file = os.path.join(current_app.config['VIDEO_DIR'], 'forbidden.mp4')
     if not os.path.exists(video_file):
         abort(404)
-    if 'Range' in request.headers:
-        return send_video_file(video_file=video_file, request=request)
-    return send_file(video_file, mimetype='video/mp4')
+    return send_video_file(video_file=video_file, request=request)
@@ -2,17 +2,23 @@
 
 '''app/views/study.py'''
 
-from htmlmin import minify
 from flask import Blueprint
 from flask import render_template, jsonify, redirect, request, url_for, abort, flash
+from flask import current_app
 from flask_login import login_required, current_user
 from app import db, csrf
-from app.models import Device
-from app.models import LessonType, Lesson, Video
+from app.models import device_index
+from app.models import Video, LessonProgress
+from app.models import SyncTask
 from app.decorators import permission_required
 from app.utils import get_mac_address_from_ip
-from app.utils import y_system_api_request, verify_data_keys
+from app.utils import request_lesson_access, verify_data_keys
+from app.utils import generate_playback_token, verify_playback_token
+from app.utils import minify
 from app.utils2 import add_user_log
+from app.punches import punch_buffer
+from app.catalog import render_catalog
+from app.metrics import hls_urls, punches, punch_duration
 
 
 study = Blueprint('study', __name__)
@@ -28,7 +34,7 @@ def vb():
     if mac_address is None:
         flash('无法获取设备信息', category='error')
         return redirect(url_for('auth.login'))
-    device = Device.query.filter_by(mac_address=mac_address).first()
+    device = device_index.device(mac_address=mac_address)
     if device is None:
         flash('设备未授权（MAC地址：{}）'.format(mac_address), category='error')
         return redirect(url_for('auth.login'))
@@ -36,15 +42,12 @@ def vb():
     if not device.can_access_lesson_type(lesson_type=lesson_type):
         flash('该设备无法访问“{}”资源'.format(lesson_type), category='error')
         return redirect(url_for('auth.login'))
-    lessons = Lesson.query\
-        .join(LessonType, LessonType.id == Lesson.type_id)\
-        .filter(LessonType.name == lesson_type)\
-        .order_by(Lesson.id.asc())
-    return minify(render_template(
-        'study/lesson.html',
-        header=lesson_type,
-        lessons=lessons
-    ))
+    return render_catalog(
+        template='study/lesson.html',
+        fragment_template='study/_catalog.html',
+        lesson_type=lesson_type,
+        user=current_user._get_current_object()
+    )
 
 
 @study.route('/y-gre')
@@ -57,7 +60,7 @@ def y_gre():
     if mac_address is None:
         flash('无法获取设备信息', category='error')
         return redirect(url_for('auth.login'))
-    device = Device.query.filter_by(mac_address=mac_address).first()
+    device = device_index.device(mac_address=mac_address)
     if device is None:
         flash('设备未授权（MAC地址：{}）'.format(mac_address), category='error')
         return redirect(url_for('auth.login'))
@@ -65,15 +68,12 @@ def y_gre():
     if not device.can_access_lesson_type(lesson_type=lesson_type):
         flash('该设备无法访问“{}”资源'.format(lesson_type), category='error')
         return redirect(url_for('auth.login'))
-    lessons = Lesson.query\
-        .join(LessonType, LessonType.id == Lesson.type_id)\
-        .filter(LessonType.name == lesson_type)\
-        .order_by(Lesson.id.asc())
-    return minify(render_template(
-        'study/lesson.html',
-        header=lesson_type,
-        lessons=lessons
-    ))
+    return render_catalog(
+        template='study/lesson.html',
+        fragment_template='study/_catalog.html',
+        lesson_type=lesson_type,
+        user=current_user._get_current_object()
+    )
 
 
 @study.route('/y-gre-aw')
@@ -86,7 +86,7 @@ def y_gre_aw():
     if mac_address is None:
         flash('无法获取设备信息', category='error')
         return redirect(url_for('auth.login'))
-    device = Device.query.filter_by(mac_address=mac_address).first()
+    device = device_index.device(mac_address=mac_address)
     if device is None:
         flash('设备未授权（MAC地址：{}）'.format(mac_address), category='error')
         return redirect(url_for('auth.login'))
@@ -94,15 +94,12 @@ def y_gre_aw():
     if not device.can_access_lesson_type(lesson_type=lesson_type):
         flash('该设备无法访问“{}”资源'.format(lesson_type), category='error')
         return redirect(url_for('auth.login'))
-    lessons = Lesson.query\
-        .join(LessonType, LessonType.id == Lesson.type_id)\
-        .filter(LessonType.name == lesson_type)\
-        .order_by(Lesson.id.asc())
-    return minify(render_template(
-        'study/lesson.html',
-        header=lesson_type,
-        lessons=lessons
-    ))
+    return render_catalog(
+        template='study/lesson.html',
+        fragment_template='study/_catalog.html',
+        lesson_type=lesson_type,
+        user=current_user._get_current_object()
+    )
 
 
 @study.route('/test-review')
@@ -115,7 +112,7 @@ def test_review():
     if mac_address is None:
         flash('无法获取设备信息', category='error')
         return redirect(url_for('auth.login'))
-    device = Device.query.filter_by(mac_address=mac_address).first()
+    device = device_index.device(mac_address=mac_address)
     if device is None:
         flash('设备未授权（MAC地址：{}）'.format(mac_address), category='error')
         return redirect(url_for('auth.login'))
@@ -123,15 +120,12 @@ def test_review():
     if not device.can_access_lesson_type(lesson_type=lesson_type):
         flash('该设备无法访问“{}”资源'.format(lesson_type), category='error')
         return redirect(url_for('auth.login'))
-    lessons = Lesson.query\
-        .join(LessonType, LessonType.id == Lesson.type_id)\
-        .filter(LessonType.name == lesson_type)\
-        .order_by(Lesson.id.asc())
-    return minify(render_template(
-        'study/lesson.html',
-        header=lesson_type,
-        lessons=lessons
-    ))
+    return render_catalog(
+        template='study/lesson.html',
+        fragment_template='study/_catalog.html',
+        lesson_type=lesson_type,
+        user=current_user._get_current_object()
+    )
 
 
 @study.route('/video/<int:id>')
@@ -144,57 +138,73 @@ def video(id):
         flash('无法研修当前课程：{}'.format(video.lesson.name), category='warning')
         return redirect(url_for('study.{}'.format(video.lesson.type.view_point)))
     if video.lesson.type.name in ['VB', 'Y-GRE', 'Y-GRE AW']:
-        data = y_system_api_request(api='lesson-access', token_data={
-            'user_id': current_user.id,
-            'lesson': video.lesson.name,
-        })
+        data = request_lesson_access(user_id=current_user.id, lesson=video.lesson.name)
         if data is None:
             flash('网络通信故障', category='error')
             return redirect(url_for('study.{}'.format(video.lesson.type.view_point)))
         if verify_data_keys(data=data, keys=['error']):
             flash('无法研修当前课程：{}'.format(data.get('error')), category='error')
             return redirect(url_for('study.{}'.format(video.lesson.type.view_point)))
+    playback_token = None
+    if current_user.can_play(video=video):
+        playback_token = generate_playback_token(user_id=current_user.id, video_id=video.id)
+    if current_app.config['HLS_ENABLE']:
+        hls_urls.inc(lesson_type=video.lesson.type.name)
     return minify(render_template(
         'study/video.html',
-        video=video
+        video=video,
+        playback_token=playback_token
     ))
 
 
 @study.route('/punch/<int:id>', methods=['POST'])
 @login_required
 @permission_required('研修')
+@punch_duration.time()
 def punch(id):
     '''study.punch(id)'''
     csrf.protect()
     video = Video.query.get_or_404(id)
-    if not current_user.can_play(video=video):
-        abort(403)
     if request.json is None:
         abort(500)
-    if not current_user.punched(video=video):
-        add_user_log(
-            user=current_user._get_current_object(),
-            event='视频研修：{}'.format(video.name),
-            category='study'
-        )
-    current_user.punch(video=video, play_time=request.json.get('play_time'))
-    db.session.commit()
-    if video.lesson.type.name in ['VB', 'Y-GRE', 'Y-GRE AW']:
-        # synchronize study progress with Y-System
-        punch = current_user.get_punch(video=video)
-        if punch.sync_required:
-            data = y_system_api_request(api='punch', token_data={
-                'user_id': current_user.id,
-                'section': video.section,
-            })
-            if verify_data_keys(data=data, keys=['success']):
-                punch.set_synchronized()
-                add_user_log(
-                    user=current_user._get_current_object(),
-                    event='同步研修进度至Y-System：{}'.format(video.section),
-                    category='study'
-                )
+    # a valid playback token proves can_play was checked when the video page was rendered
+    if not verify_playback_token(
+        token=request.json.get('playback_token'),
+        user_id=current_user.id,
+        video_id=video.id
+    ) and not current_user.can_play(video=video):
+        abort(403)
+    play_time = request.json.get('play_time')
+    # the progress of this lesson only: the whole catalog is read when a milestone is written through
+    progress = LessonProgress(user_id=current_user.id, lesson=video.lesson)
+    punched = progress.punched(video_id=video.id)
+    milestone = play_time is not None and progress.record(video_id=video.id, play_time=play_time)
+    buffer = punch_buffer()
+    buffered = buffer is not None and play_time is not None and punched and not milestone
+    if not buffered:
+        # the first punch is written through, so its user log is never lost or repeated
+        # a milestone is written through, so every worker process sees the unlocked videos/lessons
+        if not punched:
+            add_user_log(
+                user=current_user._get_current_object(),
+                event='视频研修：{}'.format(video.name),
+                category='study'
+            )
+        if buffer is not None:
+            buffer.discard(user_id=current_user.id, video_id=video.id)
+        current_user.punch(video=video, play_time=play_time)
+        db.session.commit()
+        if video.lesson.type.name in ['VB', 'Y-GRE', 'Y-GRE AW']:
+            # synchronize study progress with Y-System
+            # queued for the background sync worker: Punch.synchronized flips on acknowledgement
+            punch = current_user.get_punch(video=video)
+            if punch.sync_required and SyncTask.enqueue(user=current_user._get_current_object(), video=video):
                 db.session.commit()
+    else:
+        buffer.record(user_id=current_user.id, video_id=video.id, play_time=play_time)
+        current_user.reset_progress_snapshot()
+    punches.inc(mode='buffered' if buffered else 'direct')
     return jsonify({
-        'progress': current_user.video_progress(video=video),
+        'progress': progress.video_progress(video_id=video.id),
+        'playback_token': generate_playback_token(user_id=current_user.id, video_id=video.id),
     })
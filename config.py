@@ -19,6 +19,22 @@ class Config:
     VIDEO_DIR = os.path.join(DATA_DIR, 'videos')
     CACHE_DIR = os.path.join(BASE_DIR, 'cache')
     HLS_DIR = os.path.join(CACHE_DIR, 'hls')
+    HLS_SEGMENT_DIR = os.path.join(CACHE_DIR, 'segments')
+
+    # HLS
+    HLS_CACHE_STRATEGIES = ['reflink', 'hardlink', 'symlink', 'copy'] # tried in order
+    HLS_ROTATION_SCHEDULER = False # rotate HLS cache tokens in-process at each date boundary
+    HLS_PACKAGING = False # serve pre-packaged HLS segments instead of renamed MP4 files
+    HLS_PACKAGING_WORKERS = 2
+    HLS_PACKAGING_THREADS = 2 # ffmpeg encoder threads per worker
+    HLS_PACKAGING_NICENESS = 10
+    HLS_SEGMENT_DURATION = 6 # seconds
+    HLS_RENDITIONS = [
+        {'name': '360p', 'height': 360, 'video_bitrate': '800k', 'audio_bitrate': '96k'},
+        {'name': '540p', 'height': 540, 'video_bitrate': '1400k', 'audio_bitrate': '128k'},
+        {'name': '720p', 'height': 720, 'video_bitrate': '2800k', 'audio_bitrate': '128k'},
+    ] # empty: segment the source stream without re-encoding
+    FFMPEG_BINARY = 'ffmpeg'
 
     # SSL
     SSL_DISABLE = True
@@ -36,11 +52,25 @@ class Config:
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SLOW_DB_QUERY_TIME = 0.5 # seconds
 
+    # Profiling
+    PROFILING_ENABLE = False # per-request query count and timings
+    PROFILING_SERVER_TIMING = False # expose them to developers as a Server-Timing response header
+    PROFILING_SAMPLE_SIZE = 200 # recent requests kept per endpoint and worker process
+    PROFILING_QUERY_BUDGET = 50 # queries per request before a warning is logged (None: no budget)
+    PROFILING_QUERY_BUDGETS = {} # per-endpoint overrides, e.g. {'status.home': 100}
+
+    # Metrics
+    METRICS_TOKEN = os.getenv('YVOD_METRICS_TOKEN') # None: the /metrics endpoint is disabled
+    METRICS_EXPORT_INTERVAL = 15 # seconds: each worker process writes its metrics for aggregation
+
     # Query
     RECORD_PER_PAGE = 20
     RECORD_PER_PAGE_FEWER = 10
     RECORD_PER_QUERY = 50
 
+    # Rendering
+    MINIFY_TEMPLATES = True # collapse whitespace when templates are loaded (False: htmlmin every response)
+
     # Time
     DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
     DATETIME_FORMAT_ISO = '%Y-%m-%dT%H:%M:%SZ'
@@ -48,16 +78,50 @@ class Config:
     COOKIE_MAX_AGE = 30 * 24 * 60 * 60 # 30 days
     STATUS_EXPIRATION_CHECK_INTERVAL = 1000 # milliseconds (1 second)
     TOKEN_EXPIRATION = 3600 # seconds
+    PLAYBACK_TOKEN_EXPIRATION = 300 # seconds (renewed by every punch)
     REQUEST_TIMEOUT = 15 # seconds
 
+    # Device Identification
+    MAC_ADDRESS_CACHE_SIZE = 1024 # IP addresses per worker process
+    MAC_ADDRESS_CACHE_TTL = 60 # seconds (bounds how long a reassigned IP keeps its old MAC)
+    MAC_ADDRESS_CACHE_PREWARM = True # refresh the cache from the kernel ARP table (Linux only)
+    MAC_ADDRESS_CACHE_PREWARM_INTERVAL = 30 # seconds
+    PRESENCE_TRACKER_ENABLE = True # keep last_seen_at in memory instead of a commit on every request
+    PRESENCE_FLUSH_INTERVAL = 60 # seconds: last_seen_at lags by at most this much
+
+    # Video Streaming
+    VIDEO_CHUNK_SIZE = 64 * 1024 # bytes (64 KB)
+    VIDEO_MAX_RANGES = 16 # byte ranges per request after coalescing (more: the whole file is served)
+    VIDEO_OFFLOAD = os.getenv('YVOD_VIDEO_OFFLOAD') # None, 'X-Accel-Redirect' or 'X-Sendfile'
+    VIDEO_OFFLOAD_LOCATION = '/protected/videos' # internal proxy location aliased to VIDEO_DIR
+    VIDEO_SENDFILE = True # serve whole files through wsgi.file_wrapper
+    VIDEO_SENDFILE_RANGES = False # only if the WSGI server honors the file offset (e.g. gunicorn)
+
     # Video Analytics
     VIDEO_ANALYTICS_ACCELERATING_FACTOR = 1.25 # speedup
     VIDEO_ANALYTICS_GRANULARITY = 100 # milliseconds (0.1 seconds)
     VIDEO_ANALYTICS_UPDATE_PUNCH_INTERVAL = 15 * 1000 # milliseconds (15 seconds)
     VIDEO_ANALYTICS_STATUS_EXPIRATION = 300 # seconds (5 minutes)
+    PUNCH_BUFFER_ENABLE = True # coalesce punches in memory and write them in batches
+    PUNCH_BUFFER_FLUSH_INTERVAL = 5 # seconds
+    PUNCH_BUFFER_FSYNC = True # fsync the punch journal on every punch
 
     # Y-System
     YSYS_URI = os.getenv('YVOD_YSYS_URL')
+    YSYS_POOL_SIZE = 10 # keep-alive connections per worker process
+    YSYS_CONNECT_TIMEOUT = 3 # seconds per connection attempt
+    YSYS_RETRIES = 2 # connection failures and 502/503/504 responses (GET only)
+    YSYS_RETRY_BACKOFF = 0.3 # seconds, doubled after each retry
+    YSYS_BREAKER_FAILURE_THRESHOLD = 5 # consecutive failed requests before failing fast
+    YSYS_BREAKER_RESET_TIMEOUT = 30 # seconds before a probe request is let through
+    YSYS_SYNC_INTERVAL = 10 # seconds
+    YSYS_SYNC_BATCH_SIZE = 50 # queued sections per run
+    YSYS_SYNC_RETRY_BASE = 15 # seconds, doubled after each failed attempt
+    YSYS_SYNC_RETRY_MAX = 60 * 60 # seconds (1 hour)
+    LESSON_ACCESS_CACHE_SIZE = 4096 # (user, lesson) decisions per worker process
+    LESSON_ACCESS_CACHE_TTL = 10 * 60 # seconds (10 minutes)
+    LESSON_ACCESS_CACHE_NEGATIVE_TTL = 60 # seconds (1 minute)
+    LESSON_ACCESS_CACHE_STALE_TTL = 60 * 60 # seconds (1 hour): served while Y-System is unreachable
 
     # Development
     SYSTEM_OPERATOR_NAME = os.getenv('YVOD_SYSTEM_OPERATOR_NAME')
@@ -89,6 +153,10 @@ class DevelopmentConfig(Config):
     # HLS
     HLS_ENABLE = False
 
+    # Profiling
+    PROFILING_ENABLE = True
+    PROFILING_SERVER_TIMING = True
+
 
 class ProductionConfig(Config):
     '''ProductionConfig(Config)'''
@@ -110,6 +178,7 @@ class ProductionConfig(Config):
 
     # HLS
     HLS_ENABLE = True
+    HLS_ROTATION_SCHEDULER = True
 
     @classmethod
     def init_app(cls, app):
@@ -147,5 +147,296 @@ def backup():
     UserLog.backup_entries(data=data)
 
 
+@manager.command
+def rotate_hls(force=False):
+    '''Rotate HLS cache tokens'''
+    from app.models import Video
+    count = Video.refresh_hls_caches(force=force, verbose=True)
+    print('---> {} HLS cache(s) rotated.'.format(count))
+
+
+@manager.command
+def package_hls(workers=None, force=False):
+    '''Package videos into HLS segments'''
+    from app.models import Video
+    count = Video.package_hls(
+        workers=(None if workers is None else int(workers)),
+        force=force,
+        verbose=True
+    )
+    print('---> {} video(s) packaged.'.format(count))
+
+
+@manager.command
+def refresh_lesson_durations():
+    '''Recompute lesson durations'''
+    from app.models import Lesson
+    count = Lesson.refresh_durations(verbose=True)
+    print('---> {} lesson duration(s) updated.'.format(count))
+
+
+@manager.command
+def sync_ysys():
+    '''Synchronize queued study progress with Y-System'''
+    from app.models import SyncTask
+    count = SyncTask.process(verbose=True)
+    print('---> {} section(s) synchronized.'.format(count))
+
+
+@manager.command
+def ysys_stub(host='127.0.0.1', port=5100, failure_rate=0.0, delay=0.0):
+    '''Run a local stub Y-System API'''
+    import json
+    from time import sleep
+    from random import random
+    from itsdangerous import TimedJSONWebSignatureSerializer, BadData
+    from werkzeug.serving import run_simple
+    from werkzeug.wrappers import Request, Response
+    serial = TimedJSONWebSignatureSerializer(secret_key=app.config['AUTH_TOKEN_SECRET_KEY'])
+
+    @Request.application
+    def application(request):
+        parts = request.path.strip('/').split('/')
+        if len(parts) != 3 or parts[0] != 'api':
+            return Response(status=404)
+        sleep(float(delay))
+        if random() < float(failure_rate):
+            return Response(status=503)
+        try:
+            token_data = serial.loads(parts[2])
+        except BadData:
+            data = {'error': 'Invalid token'}
+        else:
+            print('Y-System API', parts[1], token_data)
+            if parts[1] == 'punch':
+                data = {'success': True}
+            elif parts[1] == 'lesson-access':
+                data = {'lesson': token_data.get('lesson')}
+            else:
+                data = {'error': 'Unknown API: {}'.format(parts[1])}
+        return Response(json.dumps(data), mimetype='application/json')
+
+    print('---> Y-System stub: http://{}:{}'.format(host, port))
+    run_simple(host, int(port), application)
+
+
+@manager.command
+def benchmark_video(video_file=None, rounds=3):
+    '''Benchmark video file serving'''
+    from time import perf_counter, process_time
+    from app.utils import iter_file_range
+    if video_file is None:
+        video_file = os.path.join(app.config['VIDEO_DIR'], 'forbidden.mp4')
+    if not os.path.exists(video_file):
+        print('视频文件不存在', video_file)
+        return
+    file_size = os.path.getsize(video_file)
+    chunk_size = app.config['VIDEO_CHUNK_SIZE']
+
+    def read_into_bytes(out):
+        with open(video_file, 'rb') as f:
+            out.write(f.read(file_size))
+
+    def chunked(out):
+        for chunk in iter_file_range(video_file, 0, file_size - 1, chunk_size):
+            out.write(chunk)
+
+    def sendfile(out):
+        out.flush()
+        with open(video_file, 'rb') as f:
+            offset = 0
+            while offset < file_size:
+                sent = os.sendfile(out.fileno(), f.fileno(), offset, file_size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+
+    print('---> Benchmark: {} ({:.1f} MB, {} rounds)'.format(video_file, file_size / 2**20, rounds))
+    for name, method in [('read', read_into_bytes), ('chunked', chunked), ('sendfile', sendfile)]:
+        wall_time = 0.0
+        cpu_time = 0.0
+        for _ in range(int(rounds)):
+            with open(os.devnull, 'wb') as out:
+                wall_start, cpu_start = perf_counter(), process_time()
+                method(out)
+                wall_time += perf_counter() - wall_start
+                cpu_time += process_time() - cpu_start
+        served = file_size * int(rounds) / 2**30
+        print('{:<10}{:>10.1f} MB/s{:>10.3f} CPU s/GB'.format(
+            name,
+            served * 1024 / wall_time if wall_time > 0 else float('inf'),
+            cpu_time / served
+        ))
+
+
+@manager.command
+def benchmark_before_request(ip_address='127.0.0.1', user_id=None, rounds=200):
+    '''Benchmark per-request authentication overhead'''
+    from time import perf_counter
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    from flask_login import login_user
+    from app.models import User
+    from app.utils import mac_address_cache
+    from app.views.auth import before_request
+    if user_id is None:
+        user = User.query.first()
+    else:
+        user = User.query.get(int(user_id))
+    if user is None:
+        print('用户不存在', user_id)
+        return
+    query_count = [0]
+
+    def count_query(*args):
+        query_count[0] += 1
+
+    print('---> Benchmark: {} from {} ({} rounds)'.format(user.name_with_role, ip_address, rounds))
+    event.listen(Engine, 'before_cursor_execute', count_query)
+    try:
+        for name, clear_cache in [('uncached', True), ('cached', False)]:
+            mac_address_cache().invalidate()
+            query_count[0] = 0
+            wall_time = 0.0
+            for _ in range(int(rounds)):
+                if clear_cache:
+                    mac_address_cache().invalidate()
+                with app.test_request_context(environ_base={'REMOTE_ADDR': ip_address}):
+                    login_user(user)
+                    wall_start = perf_counter()
+                    before_request()
+                    wall_time += perf_counter() - wall_start
+            print('{:<10}{:>10.2f} queries{:>10.3f} ms/request'.format(
+                name,
+                query_count[0] / int(rounds),
+                wall_time * 1000 / int(rounds)
+            ))
+    finally:
+        event.remove(Engine, 'before_cursor_execute', count_query)
+
+
+@manager.command
+def benchmark_minify(user_id=None, rounds=20):
+    '''Benchmark HTML minification of the main pages'''
+    from time import perf_counter
+    import htmlmin
+    from flask import url_for
+    from flask_login import login_user
+    from werkzeug.exceptions import HTTPException
+    from app.models import User
+    if user_id is None:
+        user = User.query.filter(User.role.has(name='开发人员')).first()
+    else:
+        user = User.query.get(int(user_id))
+    if user is None:
+        print('用户不存在', user_id)
+        return
+    endpoints = [
+        'profile.overview',
+        'profile.timeline',
+        'status.home',
+        'study.vb',
+        'study.y_gre',
+        'manage.student',
+        'manage.staff',
+        'manage.device',
+        'manage.lesson',
+        'develop.log',
+        'develop.configuration',
+    ]
+    print('---> Benchmark: {} ({} rounds, MINIFY_TEMPLATES={})'.format(
+        user.name_with_role,
+        rounds,
+        app.config['MINIFY_TEMPLATES']
+    ))
+    for endpoint in endpoints:
+        with app.test_request_context():
+            url = url_for(endpoint, **({'id': user.id} if endpoint.startswith('profile.') else {}))
+        # every round is a full request: templates are minified once, when they are loaded
+        html = None
+        timings = []
+        for _ in range(int(rounds) + 1):
+            with app.test_request_context(url):
+                login_user(user)
+                start = perf_counter()
+                try:
+                    if app.preprocess_request() is None:
+                        html = app.make_response(app.dispatch_request()).get_data(as_text=True)
+                except HTTPException:
+                    html = None
+                timings.append(perf_counter() - start)
+        if html is None:
+            print('{:<25}{:>10}'.format(endpoint, 'skipped'))
+            continue
+        start = perf_counter()
+        minified = htmlmin.minify(html)
+        htmlmin_time = perf_counter() - start
+        print('{:<25}{:>8.1f} KB{:>10.2f} ms/request{:>10.2f} ms htmlmin{:>8.1f} KB htmlmin'.format(
+            endpoint,
+            len(html) / 1024,
+            sum(timings[1:]) * 1000 / int(rounds),
+            htmlmin_time * 1000,
+            len(minified) / 1024
+        ))
+
+
+@manager.command
+def benchmark_progress(user_id=None):
+    '''Benchmark study progress queries'''
+    from time import perf_counter
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    from app.models import User, Video, Lesson, LessonType, Punch
+    if user_id is None:
+        user = User.query.join(Punch, Punch.user_id == User.id).first()
+    else:
+        user = User.query.get(int(user_id))
+    if user is None:
+        print('用户不存在', user_id)
+        return
+    videos = Video.query\
+        .join(Lesson, Lesson.id == Video.lesson_id)\
+        .join(LessonType, LessonType.id == Lesson.type_id)\
+        .filter(LessonType.name == 'VB')\
+        .order_by(Video.id.asc())\
+        .all()
+    query_count = [0]
+
+    def count_query(*args):
+        query_count[0] += 1
+
+    # the per-video lookups User.can_play used before the progress snapshot
+    def legacy_complete_video(video):
+        punch = user.punches.filter_by(video_id=video.id).first()
+        return punch is not None and punch.progress_trim >= video.lesson.progress_threshold
+
+    def legacy_can_play(video):
+        for item in Video.query\
+            .join(Lesson, Lesson.id == Video.lesson_id)\
+            .filter(Lesson.type_id == video.lesson.type_id)\
+            .filter(Video.id < video.id)\
+            .all():
+            if not legacy_complete_video(video=item):
+                return False
+        return True
+
+    def snapshot_can_play(video):
+        return user.can_play(video=video)
+
+    print('---> Benchmark: {} ({} VB videos)'.format(user.name_with_role, len(videos)))
+    event.listen(Engine, 'before_cursor_execute', count_query)
+    try:
+        for name, method in [('legacy', legacy_can_play), ('snapshot', snapshot_can_play)]:
+            user.reset_progress_snapshot()
+            query_count[0] = 0
+            wall_start = perf_counter()
+            for video in videos:
+                method(video=video)
+            wall_time = perf_counter() - wall_start
+            print('{:<10}{:>10} queries{:>10.1f} ms'.format(name, query_count[0], wall_time * 1000))
+    finally:
+        event.remove(Engine, 'before_cursor_execute', count_query)
+
+
 if __name__ == '__main__':
     manager.run()